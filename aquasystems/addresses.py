@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import time
+
+# Default location of the device name to address cache
+DEFAULT_ADDRESS_CACHE = os.path.join('~', '.aquasystems', 'addresses.json')
+
+
+class JsonCache:
+    """Key value pairs kept in a small JSON file between restarts
+
+    """
+
+    def __init__(self, path):
+        """
+
+        :param path: JSON file path, created when first saved
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = os.path.expanduser(path)
+        self.entries = {}
+        self._dirty = False
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.debug('No cache loaded from {}: {}'.format(self.path, e))
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        if self.entries.get(key) != value:
+            self.entries[key] = value
+            self._dirty = True
+
+    def remove(self, key):
+        if self.entries.pop(key, None) is not None:
+            self._dirty = True
+
+    def save(self):
+        """Write the cache if it changed, replacing the file atomically
+
+        """
+        if not self._dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+class AddressCache(JsonCache):
+    """Device name to address mappings kept between restarts
+
+    """
+
+    def __init__(self, path=DEFAULT_ADDRESS_CACHE):
+        super().__init__(path)
+
+
+def find_cached_devices(ble, cache, names):
+    """Find devices the provider already knows by their cached address, without scanning
+
+    :param ble: BLE provider
+    :param cache: AddressCache
+    :param names: device names
+    :return: dict of device name to device
+    """
+    known = {device.id: device for device in ble.list_devices()}
+    devices = {}
+    for name in names:
+        device = known.get(cache.get(name))
+        if device is not None:
+            devices[name] = device
+    return devices
+
+
+def scan_devices(ble, adapter, names, timeout_sec=60, ignore=()):
+    """Find several devices by name in a single scan
+
+    :param ble: BLE provider
+    :param adapter: BLE adapter
+    :param names: device names
+    :param timeout_sec: seconds to scan for before giving up on missing devices
+    :param ignore: addresses to skip, e.g. a stale address that failed to connect
+    :return: dict of device name to device for the devices found
+    """
+    wanted = set(names)
+    devices = {}
+    adapter.start_scan()
+    try:
+        deadline = time.monotonic() + timeout_sec
+        while True:
+            for device in ble.find_devices():
+                if device.name in wanted and device.name not in devices and device.id not in ignore:
+                    devices[device.name] = device
+            if len(devices) == len(wanted) or time.monotonic() >= deadline:
+                break
+            time.sleep(0.5)
+    finally:
+        # Make sure scanning is stopped before exiting.
+        adapter.stop_scan()
+    return devices
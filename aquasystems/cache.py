@@ -0,0 +1,75 @@
+import time
+from collections import Counter
+
+# TTL for values that only change when written, e.g. cycle_frequency
+CACHE_UNTIL_WRITE = float('inf')
+
+
+class AttributeCache:
+    """Read-through cache of decoded attribute values with a TTL per attribute
+
+    Attributes without a TTL are never cached. Hits and misses are counted per
+    attribute to help tune the TTLs.
+
+    """
+
+    def __init__(self, ttl=None, clock=time.monotonic):
+        """
+
+        :param ttl: dict of attribute name to TTL in seconds
+        :param clock: function returning the current time in seconds
+        """
+        self.ttl = dict(ttl or {})
+        self.clock = clock
+        self.hits = Counter()
+        self.misses = Counter()
+        self._entries = {}
+
+    def get(self, item):
+        """Get a cached value
+
+        :param item: name of item
+        :return: tuple of (found, value)
+        """
+        entry = self._entries.get(item)
+        if entry is not None:
+            expires, value = entry
+            if expires > self.clock():
+                self.hits[item] += 1
+                return True, value
+            del self._entries[item]
+        self.misses[item] += 1
+        return False, None
+
+    def set(self, item, value):
+        """Store a value if the item has a TTL
+
+        :param item: name of item
+        :param value: decoded value
+        :return:
+        """
+        ttl = self.ttl.get(item)
+        if not ttl:
+            return
+        self._entries[item] = (self.clock() + ttl, value)
+
+    def invalidate(self, item=None):
+        """Drop the cached value of an item, or all values if no item given
+
+        :param item: name of item
+        :return:
+        """
+        if item is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(item, None)
+
+    @property
+    def stats(self):
+        """Return dict of hit and miss counts per attribute
+
+        """
+        return {
+            item: {'hits': self.hits[item], 'misses': self.misses[item]}
+            for item in set(self.hits) | set(self.misses)
+        }
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import deque
+
+SECONDS_PER_DAY = 86400
+
+
+def seconds_of_day(value):
+    """Convert a time of day [hours, minutes, seconds] to seconds since midnight
+
+    """
+    hours, minutes, seconds = value
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def time_of_day(seconds):
+    """Convert seconds since midnight to a time of day [hours, minutes, seconds], wrapping at midnight
+
+    """
+    seconds = int(round(seconds)) % SECONDS_PER_DAY
+    return [seconds // 3600, seconds // 60 % 60, seconds % 60]
+
+
+def _wrap(offset):
+    """Bring an offset between two times of day into -12h to +12h"""
+    return (offset + SECONDS_PER_DAY / 2) % SECONDS_PER_DAY - SECONDS_PER_DAY / 2
+
+
+class ClockModel:
+    """Estimate of a device clock from occasional reads, as its offset from local time and its drift
+
+    Each read of the device clock adds a sample of its offset from local time. The
+    drift is the slope of a least squares fit of the samples once they span
+    min_drift_span seconds, until then the last offset is used as is.
+
+    """
+
+    def __init__(self, max_samples=16, min_drift_span=3600, clock=time.monotonic, wall_clock=time.time):
+        """
+
+        :param max_samples: offsets kept for the drift fit
+        :param min_drift_span: seconds the samples have to span before the drift is estimated
+        :param clock: function returning the current time in seconds, to time the samples
+        :param wall_clock: function returning the current epoch time, for local time of day
+        """
+        self.min_drift_span = min_drift_span
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    @property
+    def calibrated(self):
+        """True once the device clock has been read
+
+        """
+        return bool(self._samples)
+
+    def local_seconds(self):
+        """Return the local time of day in seconds since midnight
+
+        """
+        wall_time = self.wall_clock()
+        now = time.localtime(wall_time)
+        return now.tm_hour * 3600 + now.tm_min * 60 + now.tm_sec + wall_time % 1
+
+    def local_time(self):
+        """Return the local time of day as [hours, minutes, seconds], the value to set the device clock to
+
+        """
+        return time_of_day(self.local_seconds())
+
+    def add_sample(self, value):
+        """Record a read of the device clock, just made
+
+        :param value: device time of day [hours, minutes, seconds]
+        :return:
+        """
+        offset = _wrap(seconds_of_day(value) - self.local_seconds())
+        with self._lock:
+            self._samples.append((self.clock(), offset))
+
+    def corrected(self, value):
+        """Record that the device clock was just set, keeping the drift estimate
+
+        :param value: time of day written [hours, minutes, seconds]
+        :return:
+        """
+        if not self.calibrated:
+            self.add_sample(value)
+            return
+        shift = _wrap(seconds_of_day(value) - self.local_seconds()) - self.offset()
+        with self._lock:
+            self._samples = deque(((t, offset + shift) for t, offset in self._samples), maxlen=self._samples.maxlen)
+
+    @property
+    def drift(self):
+        """Seconds the device clock gains per second, 0 until the samples span min_drift_span
+
+        """
+        with self._lock:
+            return self._fit()[1]
+
+    def offset(self, at=None):
+        """Return the seconds the device clock is ahead of local time
+
+        :param at: clock time, defaults to now
+        :return: seconds, negative if behind
+        """
+        at = self.clock() if at is None else at
+        with self._lock:
+            if not self._samples:
+                raise RuntimeError('device clock has not been read')
+            mean_t, slope, mean_offset = self._fit()
+        return mean_offset + slope * (at - mean_t)
+
+    def device_time(self):
+        """Return the estimated device time of day [hours, minutes, seconds]
+
+        """
+        return time_of_day(self.local_seconds() + self.offset())
+
+    def _fit(self):
+        """Return the mean sample time, the drift and the mean offset of the samples
+
+        """
+        if not self._samples:
+            return 0.0, 0.0, 0.0
+        count = len(self._samples)
+        mean_t = sum(t for t, offset in self._samples) / count
+        mean_offset = sum(offset for t, offset in self._samples) / count
+        if self._samples[-1][0] - self._samples[0][0] < self.min_drift_span:
+            # too close together to tell drift from read jitter, use the latest offset
+            return self._samples[-1][0], 0.0, self._samples[-1][1]
+        variance = sum((t - mean_t) ** 2 for t, offset in self._samples)
+        slope = sum((t - mean_t) * (offset - mean_offset) for t, offset in self._samples) / variance
+        return mean_t, slope, mean_offset
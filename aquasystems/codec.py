@@ -0,0 +1,136 @@
+import struct
+from operator import itemgetter
+
+
+class FrameError(ValueError):
+    """Raised when a raw characteristic value does not match its format."""
+
+
+def to_bytes(raw):
+    """Convert a raw characteristic value to bytes
+
+    The bluez provider returns reads as a dbus.Array of bytes and notifications as a str
+    with one character per byte, other providers return bytes like values.
+
+    :param raw: bytes like value, list of ints or str
+    :return: bytes
+    """
+    if isinstance(raw, str):
+        try:
+            return raw.encode('latin-1')
+        except UnicodeEncodeError as e:
+            raise FrameError('malformed frame {!r}: {}'.format(raw, e))
+    try:
+        return bytes(bytearray(raw))
+    except (TypeError, ValueError) as e:
+        raise FrameError('malformed frame {!r}: {}'.format(raw, e))
+
+
+class AttributeCodec:
+    """Encoder/decoder for a TimerService attribute format list
+
+    Format lists mix fixed byte values (int) with named value fields (str), e.g.
+    ``[84, 4, 'hours', 'minutes', 'seconds', 4]``. The leading fixed bytes are the
+    frame header (op code and payload length) and are checked on decode.
+
+    """
+
+    __slots__ = ('format', 'size', 'header', 'fields', 'names', 'template', '_runs', '_unpacker', '_single',
+                 '_field', '_header_list', '_header_size', '_pick', '_span')
+
+    def __init__(self, fmt):
+        self.format = tuple(fmt)
+        self.size = len(self.format)
+
+        # op code and length bytes, if the frame has them
+        header = bytearray()
+        for el in self.format[:2]:
+            if type(el) != int:
+                break
+            header.append(el)
+        self.header = bytes(header)
+
+        self.fields = tuple(idx for idx, el in enumerate(self.format) if type(el) == str)
+        self.names = tuple(self.format[idx] for idx in self.fields)
+        self.template = bytes(el if type(el) == int else 0 for el in self.format)
+        self._single = len(self.fields) == 1
+        self._field = self.fields[0] if self._single else None
+        self._header_list = list(self.header)
+        self._header_size = len(self.header)
+
+        # contiguous runs of value fields as (frame start, frame stop, value start)
+        runs = []
+        for pos, idx in enumerate(self.fields):
+            if runs and runs[-1][1] == idx:
+                runs[-1][1] += 1
+            else:
+                runs.append([idx, idx + 1, pos])
+        self._runs = tuple((start, stop, pos, pos + stop - start) for start, stop, pos in runs)
+        # value fields picked straight out of a list of byte values
+        self._pick = itemgetter(*self.fields)
+        # frame slice taking all values at once when they are contiguous
+        self._span = slice(self._runs[0][0], self._runs[0][1]) if len(self._runs) == 1 else None
+
+        # unpack the header and value fields in one pass, skipping the other fixed bytes
+        layout = ['B' if type(el) == str else 'x' for el in self.format[len(self.header):]]
+        self._unpacker = struct.Struct('<{}s{}'.format(len(self.header), ''.join(layout)))
+
+    def decode(self, raw):
+        """Decode a raw characteristic value
+
+        :param raw: bytes like value read from the device, or a list or str as given by bluez
+        :return: single value if the format has one field, otherwise list of values, items of a list keep their int type
+        """
+        if isinstance(raw, list):
+            # a dbus.Array from bluez, values are picked by index without copying to bytes
+            if len(raw) != self.size or raw[:self._header_size] != self._header_list:
+                raise self._sequence_error(raw)
+            if self._single:
+                return raw[self._field]
+            return list(self._pick(raw))
+        raw_type = type(raw)
+        if raw_type is not bytes and raw_type is not bytearray:
+            raw = to_bytes(raw)
+        try:
+            values = self._unpacker.unpack(raw)
+        except (struct.error, TypeError) as e:
+            raise FrameError('malformed frame {!r}: {}'.format(raw, e))
+
+        if values[0] != self.header:
+            raise FrameError('unexpected header {}, expected {}'.format(
+                list(values[0]), list(self.header)))
+
+        if self._single:
+            return values[1]
+        return list(values[1:])
+
+    def _sequence_error(self, raw):
+        if len(raw) != self.size:
+            return FrameError('malformed frame {!r}: expected {} bytes'.format(list(raw), self.size))
+        return FrameError('unexpected header {}, expected {}'.format(
+            list(raw[:self._header_size]), self._header_list))
+
+    def encode(self, value):
+        """Encode a value into a raw characteristic value
+
+        :param value: single value or list of values matching the format fields
+        :return: bytearray
+        """
+        byte_val = bytearray(self.template)
+        value_type = type(value)
+        if self._single and value_type is not list and value_type is not tuple:
+            byte_val[self._field] = value
+            return byte_val
+        if value_type is list or value_type is tuple:
+            if len(value) != len(self.fields):
+                raise ValueError('expected {} values {}, got {}'.format(
+                    len(self.fields), list(self.names), len(value)))
+            if self._span is not None:
+                byte_val[self._span] = value
+            else:
+                for start, stop, first, last in self._runs:
+                    byte_val[start:stop] = value[first:last]
+        else:
+            raise ValueError('expected {} values {}, got {!r}'.format(
+                len(self.fields), list(self.names), value))
+        return byte_val
@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+from .connection import LatencyStats
+
+# Command priorities, lower runs first
+PRIORITY_SET = 0  # user writes
+PRIORITY_GET = 1  # user reads
+PRIORITY_POLL = 2  # background polling
+
+PRIORITY_NAMES = {
+    PRIORITY_SET: 'set',
+    PRIORITY_GET: 'get',
+    PRIORITY_POLL: 'poll'
+}
+
+
+def command_key(command):
+    """Key identifying identical requests, e.g. two gets of the same item
+
+    :param command: command dict
+    :return: hashable key
+    """
+    if command.get('cmd') == 'batch':
+        # batches are never merged, each is acked on its own
+        return 'batch', id(command)
+    item = command.get('item')
+    if isinstance(item, list):
+        item = tuple(item)
+    return command.get('cmd'), item
+
+
+class _Entry:
+    __slots__ = ('priority', 'seq', 'key', 'command', 'enqueued', 'removed')
+
+    def __init__(self, priority, seq, key, command, enqueued):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.command = command
+        self.enqueued = enqueued
+        self.removed = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class CommandQueue:
+    """Bounded priority queue of commands that coalesces identical pending requests
+
+    Commands run in priority order then arrival order. A command matching one already
+    waiting is merged into it, a set keeps the newest value and the merged command keeps
+    the higher priority. When full, background polls are dropped (new ones first, then
+    the oldest waiting) while user commands wait for space.
+
+    """
+
+    def __init__(self, maxsize=100, clock=time.monotonic, metrics=None):
+        """
+
+        :param maxsize: maximum number of waiting commands
+        :param clock: function returning the current time in seconds
+        :param metrics: optional Metrics to record wait times and drops in
+        """
+        self.maxsize = maxsize
+        self.clock = clock
+        self.metrics = metrics
+        self.dropped = 0
+        self.coalesced = 0
+        self.wait_stats = {priority: LatencyStats() for priority in PRIORITY_NAMES}
+        self._heap = []
+        self._pending = {}
+        self._seq = itertools.count()
+        self._getters = deque()
+        self._putters = deque()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def empty(self):
+        return not self._pending
+
+    def full(self):
+        return len(self._pending) >= self.maxsize
+
+    def put_nowait(self, command, priority=PRIORITY_GET):
+        """Add a command without waiting
+
+        :param command: command dict
+        :param priority: one of the PRIORITY values
+        :return: True if queued or merged, False if a background command was dropped
+        :raises asyncio.QueueFull: if a user command does not fit
+        """
+        key = command_key(command)
+        entry = self._pending.get(key)
+        if entry is not None:
+            # same request already waiting, a set keeps the newest value
+            if priority <= entry.priority:
+                entry.command = command
+            if priority < entry.priority:
+                entry.removed = True
+                entry = self._push(priority, key, command, entry.enqueued)
+            self.coalesced += 1
+            return True
+
+        while self.full():
+            if priority >= PRIORITY_POLL:
+                self._drop()
+                return False
+            victim = self._oldest_background()
+            if victim is None:
+                raise asyncio.QueueFull
+            self._remove(victim)
+            self._drop()
+
+        self._push(priority, key, command, self.clock())
+        self._wakeup(self._getters)
+        return True
+
+    async def put(self, command, priority=PRIORITY_GET):
+        """Add a command, waiting for space if a user command does not fit
+
+        :param command: command dict
+        :param priority: one of the PRIORITY values
+        :return: True if queued or merged, False if a background command was dropped
+        """
+        while True:
+            try:
+                return self.put_nowait(command, priority)
+            except asyncio.QueueFull:
+                await self._wait(self._putters)
+
+    def get_nowait(self):
+        """Remove and return the next command
+
+        :raises asyncio.QueueEmpty: if there are no commands waiting
+        """
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry.removed:
+                continue
+            del self._pending[entry.key]
+            waited = self.clock() - entry.enqueued
+            self.wait_stats[entry.priority].record(waited)
+            if self.metrics:
+                self.metrics.observe('command_wait_seconds', waited, priority=PRIORITY_NAMES[entry.priority])
+            self._wakeup(self._putters)
+            return entry.command
+        raise asyncio.QueueEmpty
+
+    async def get(self):
+        """Remove and return the next command, waiting for one if needed
+
+        """
+        while self.empty():
+            await self._wait(self._getters)
+        return self.get_nowait()
+
+    @property
+    def stats(self):
+        """Return dict of queue depth, wait times per priority and drop and merge counts
+
+        """
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for entry in self._pending.values():
+            depth[PRIORITY_NAMES[entry.priority]] += 1
+        return {
+            'depth': len(self._pending),
+            'depth_by_priority': depth,
+            'wait': {PRIORITY_NAMES[priority]: stats.as_dict() for priority, stats in self.wait_stats.items()},
+            'dropped': self.dropped,
+            'coalesced': self.coalesced
+        }
+
+    def _push(self, priority, key, command, enqueued):
+        entry = _Entry(priority, next(self._seq), key, command, enqueued)
+        heapq.heappush(self._heap, entry)
+        self._pending[key] = entry
+        return entry
+
+    def _drop(self):
+        self.dropped += 1
+        if self.metrics:
+            self.metrics.inc('commands_dropped_total')
+
+    def _remove(self, entry):
+        entry.removed = True
+        del self._pending[entry.key]
+
+    def _oldest_background(self):
+        background = [entry for entry in self._pending.values() if entry.priority >= PRIORITY_POLL]
+        if not background:
+            return None
+        return min(background, key=lambda entry: entry.seq)
+
+    async def _wait(self, waiters):
+        waiter = asyncio.get_event_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in waiters:
+                waiters.remove(waiter)
+            # pass the wakeup on if we were woken and cancelled at the same time
+            if waiter.done() and not waiter.cancelled():
+                self._wakeup(waiters)
+            raise
+
+    def _wakeup(self, waiters):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
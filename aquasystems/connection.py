@@ -0,0 +1,303 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class LinkLostError(RuntimeError):
+    """The device could not be connected or dropped its connection"""
+    pass
+
+
+class LatencyStats:
+    """Count, min, max and mean of a series of durations
+
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def record(self, seconds):
+        """Record a successful operation
+
+        :param seconds: duration of the operation
+        :return:
+        """
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def record_failure(self):
+        self.failures += 1
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'failures': self.failures,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'last': self.last
+        }
+
+
+class DeviceConnection:
+    """Connection state of a device managed by a ConnectionManager
+
+    """
+
+    def __init__(self, manager, device, on_connect=None, on_disconnect=None, metrics=None):
+        """
+
+        :param manager: ConnectionManager
+        :param device: BLE device
+        :param on_connect: optional function called after connecting, e.g. to discover services
+        :param on_disconnect: optional function called before disconnecting
+        :param metrics: optional Metrics to record connect times and failures in
+        """
+        self.manager = manager
+        self.device = device
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.metrics = metrics
+        self.connected = False
+        self.connecting = False
+        self.disconnecting = False
+        self.users = 0
+        self.last_used = 0
+        self.stats = LatencyStats()
+
+    @contextmanager
+    def connection(self):
+        """Context manager keeping the device connected while in use
+
+        """
+        self.manager.acquire(self)
+        try:
+            yield self.device
+        finally:
+            self.manager.release(self)
+
+
+class ConnectionManager:
+    """Connect to devices on demand and disconnect them once idle
+
+    A device is connected when first used and kept connected for idle_timeout seconds
+    after its last use, so bursts of operations share one connection. With
+    max_connections set, the least recently used idle device is disconnected to free
+    an adapter connection slot for another.
+
+    Connection attempts are serialised as most adapters only handle one at a time.
+    Connects and disconnects run outside the manager lock, so a device slow to connect,
+    discover or disconnect does not hold up operations on other devices.
+
+    """
+
+    def __init__(self, idle_timeout=30, max_connections=None, connect_timeout=10, clock=time.monotonic):
+        """
+
+        :param idle_timeout: seconds to keep an unused device connected, None to never disconnect
+        :param max_connections: maximum devices connected at once, None for no limit
+        :param connect_timeout: seconds to wait for a device to connect or a free slot
+        :param clock: function returning the current time in seconds
+        """
+        self.logger = logging.getLogger(__name__)
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.clock = clock
+        self.connections = []
+        self.stats = LatencyStats()
+        self._lock = threading.Condition()
+        self._connect_lock = threading.Lock()
+
+    def add(self, device, on_connect=None, on_disconnect=None, metrics=None):
+        """Add a device to manage, it is not connected until used
+
+        :param device: BLE device
+        :param on_connect: optional function called after connecting
+        :param on_disconnect: optional function called before disconnecting
+        :param metrics: optional Metrics to record connect times and failures in
+        :return: DeviceConnection
+        """
+        conn = DeviceConnection(self, device, on_connect, on_disconnect, metrics)
+        with self._lock:
+            self.connections.append(conn)
+        return conn
+
+    def acquire(self, conn):
+        """Connect the device if needed and mark it in use, blocking
+
+        :param conn: DeviceConnection
+        :return:
+        """
+        with self._lock:
+            while conn.connecting or conn.disconnecting:
+                self._lock.wait()
+            if conn.connected:
+                conn.users += 1
+                return
+            idle = self._wait_for_slot()
+            conn.connecting = True
+        for other in idle:
+            self._finish_disconnect(other)
+        try:
+            self._connect(conn)
+        finally:
+            with self._lock:
+                conn.connecting = False
+                if conn.connected:
+                    conn.users += 1
+                self._lock.notify_all()
+
+    def release(self, conn):
+        """Mark the device no longer in use
+
+        :param conn: DeviceConnection
+        :return:
+        """
+        with self._lock:
+            conn.users -= 1
+            conn.last_used = self.clock()
+            self._lock.notify_all()
+
+    def mark_lost(self, conn):
+        """Record that a device dropped its connection without being disconnected
+
+        :param conn: DeviceConnection
+        :return:
+        """
+        with self._lock:
+            if conn.connected:
+                self.logger.debug('Lost connection to {}'.format(conn.device.name))
+                conn.connected = False
+                self._lock.notify_all()
+
+    def disconnect_idle(self):
+        """Disconnect devices unused for longer than the idle timeout, blocking
+
+        :return: number of devices disconnected
+        """
+        if self.idle_timeout is None:
+            return 0
+        with self._lock:
+            now = self.clock()
+            idle = [conn for conn in self.connections
+                    if self._idle(conn) and now - conn.last_used >= self.idle_timeout]
+            for conn in idle:
+                self._start_disconnect(conn)
+        for conn in idle:
+            self._finish_disconnect(conn)
+        return len(idle)
+
+    def disconnect_all(self):
+        """Disconnect all devices, blocking
+
+        """
+        with self._lock:
+            connected = [conn for conn in self.connections if conn.connected]
+            for conn in connected:
+                self._start_disconnect(conn)
+        for conn in connected:
+            self._finish_disconnect(conn)
+
+    @property
+    def connected_count(self):
+        return sum(1 for conn in self.connections if conn.connected or conn.connecting or conn.disconnecting)
+
+    @staticmethod
+    def _idle(conn):
+        return conn.connected and not conn.connecting and not conn.users
+
+    def _wait_for_slot(self):
+        """Wait until another device can be connected, picking idle devices to disconnect if needed
+
+        :return: list of connections to disconnect with _finish_disconnect once the lock is released
+        """
+        deadline = self.clock() + self.connect_timeout
+        disconnecting = []
+        while self.max_connections and self.connected_count - len(disconnecting) >= self.max_connections:
+            idle = [conn for conn in self.connections if self._idle(conn)]
+            if idle:
+                conn = min(idle, key=lambda conn: conn.last_used)
+                self._start_disconnect(conn)
+                disconnecting.append(conn)
+                continue
+            remaining = deadline - self.clock()
+            if remaining <= 0 or not self._lock.wait(remaining):
+                # keep the idle devices picked so far connected
+                for conn in disconnecting:
+                    conn.connected = True
+                    conn.disconnecting = False
+                raise RuntimeError('No free connection slot after {}s'.format(self.connect_timeout))
+        return disconnecting
+
+    def _connect(self, conn):
+        """Connect and set up a device marked as connecting, called without holding the manager lock
+
+        """
+        self.logger.debug('Connecting to {}...'.format(conn.device.name))
+        start = self.clock()
+        device_connected = False
+        try:
+            with self._connect_lock:
+                conn.device.connect(timeout_sec=self.connect_timeout)
+            device_connected = True
+            if conn.metrics:
+                conn.metrics.observe('ble_connect_seconds', self.clock() - start)
+            if conn.on_connect:
+                conn.on_connect()
+        except Exception:
+            conn.stats.record_failure()
+            self.stats.record_failure()
+            if conn.metrics:
+                conn.metrics.inc('ble_errors_total', op='connect')
+            if device_connected:
+                self._disconnect_device(conn)
+            raise
+        elapsed = self.clock() - start
+        conn.stats.record(elapsed)
+        self.stats.record(elapsed)
+        conn.last_used = self.clock()
+        conn.connected = True
+        self.logger.debug('Connected to {} in {:.2f}s'.format(conn.device.name, elapsed))
+
+    def _start_disconnect(self, conn):
+        """Take a device out of use, called holding the manager lock
+
+        """
+        conn.connected = False
+        conn.disconnecting = True
+
+    def _finish_disconnect(self, conn):
+        """Disconnect a device taken out of use, called without holding the manager lock
+
+        """
+        try:
+            self._disconnect_device(conn)
+        finally:
+            with self._lock:
+                conn.disconnecting = False
+                self._lock.notify_all()
+
+    def _disconnect_device(self, conn):
+        self.logger.debug('Disconnecting from {}...'.format(conn.device.name))
+        try:
+            if conn.on_disconnect:
+                conn.on_disconnect()
+            conn.device.disconnect()
+        except Exception as e:
+            self.logger.error('disconnect error: {}'.format(e))
@@ -0,0 +1,101 @@
+import os
+import time
+import uuid
+
+from .addresses import JsonCache
+
+# Device Information service and its firmware revision characteristic
+DEVICE_INFO_SERVICE_UUID = uuid.UUID('0000180a-0000-1000-8000-00805f9b34fb')
+FIRMWARE_REVISION_CHAR_UUID = uuid.UUID('00002a26-0000-1000-8000-00805f9b34fb')
+
+# Default location of the GATT discovery cache
+DEFAULT_DISCOVERY_CACHE = os.path.join('~', '.aquasystems', 'gatt.json')
+
+
+def firmware_revision(device):
+    """Read the firmware revision of a connected device, if its Device Information service is resolved
+
+    :param device: connected BLE device
+    :return: firmware revision string or None
+    """
+    service = device.find_service(DEVICE_INFO_SERVICE_UUID)
+    if service is None:
+        return None
+    characteristic = service.find_characteristic(FIRMWARE_REVISION_CHAR_UUID)
+    if characteristic is None:
+        return None
+    return bytes(characteristic.read_value()).decode('utf-8', 'replace').strip('\x00 ')
+
+
+def wait_for_services(device, service_uuids, timeout_sec=10):
+    """Wait until services of a newly connected device are resolved
+
+    Services are only found some time after connecting, service discovery waits for
+    them but binding from a cached layout has to wait itself.
+
+    :param device: connected BLE device
+    :param service_uuids: services to wait for
+    :param timeout_sec: seconds to wait
+    :return: True if all services were found
+    """
+    deadline = time.monotonic() + timeout_sec
+    while not all(device.find_service(service_uuid) is not None for service_uuid in service_uuids):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def service_layout(device, service_uuids):
+    """Describe the services and characteristics found on a connected device
+
+    :param device: connected BLE device
+    :param service_uuids: services to describe
+    :return: dict of service uuid string to sorted list of characteristic uuid strings
+    """
+    layout = {}
+    for service_uuid in service_uuids:
+        service = device.find_service(service_uuid)
+        if service is not None:
+            layout[str(service_uuid)] = sorted(str(c.uuid) for c in service.list_characteristics())
+    return layout
+
+
+class DiscoveryCache(JsonCache):
+    """Service layouts of discovered devices kept between restarts, keyed by device address
+
+    An entry is only used while the device reports the firmware revision it was stored with,
+    so devices whose firmware revision cannot be read are always discovered.
+
+    """
+
+    def __init__(self, path=DEFAULT_DISCOVERY_CACHE):
+        super().__init__(path)
+
+    def lookup(self, address, firmware):
+        """Return the cached layout of a device
+
+        :param address: device address
+        :param firmware: firmware revision read from the device, None if it could not be read
+        :return: dict of service uuid string to characteristic uuid strings, or None
+        """
+        entry = self.get(address)
+        if entry is None or firmware is None:
+            return None
+        if entry.get('firmware') != firmware:
+            self.remove(address)
+            return None
+        return entry['services']
+
+    def store(self, address, firmware, services):
+        """Remember the layout of a device, unless its firmware revision is unknown
+
+        :param address: device address
+        :param firmware: firmware revision read from the device, None if it could not be read
+        :param services: dict of service uuid string to characteristic uuid strings
+        :return: True if stored
+        """
+        if firmware is None:
+            return False
+        self.set(address, {'firmware': firmware, 'services': services})
+        return True
@@ -0,0 +1,115 @@
+import json
+
+# record id marking the list of attributes that failed to read
+ERRORS_ID = 255
+
+
+def attribute_layout():
+    """Describe how each attribute is packed by the binary encoding
+
+    Attributes are numbered in name order, the number of bytes comes from the value
+    fields of the attribute format unless a converter reduces it to a single value.
+
+    :return: list of [name, width, kind] where kind is 'int', 'bool' or 'list'
+    """
+    # imported here so consumers decoding with an announced layout do not need the BLE dependencies
+    from .timer import TimerService
+
+    layout = []
+    for name in sorted(TimerService.ATTRIBUTES):
+        if name == 'on':
+            layout.append([name, 1, 'bool'])
+        elif name in TimerService.CONVERTERS:
+            layout.append([name, 1, 'int'])
+        else:
+            width = len(TimerService.CODECS[name].fields)
+            layout.append([name, width, 'int' if width == 1 else 'list'])
+    return layout
+
+
+class JsonEncoding:
+    """Payloads as UTF-8 JSON objects
+
+    """
+
+    name = 'json'
+
+    def dumps(self, payload):
+        return json.dumps(payload).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class BinaryEncoding:
+    """Payloads as a sequence of records of one attribute id byte followed by its value bytes
+
+    The attribute ids and widths come from attribute_layout() and are announced on the
+    device meta topic so consumers can decode without knowing the attribute formats.
+    Read errors are sent as a record of ERRORS_ID, a count and the failed attribute ids,
+    the error reasons are not included.
+
+    """
+
+    name = 'binary'
+
+    def __init__(self, layout=None):
+        self.layout = attribute_layout() if layout is None else layout
+        self._by_name = {}
+        self._by_id = {}
+        for attr_id, (name, width, kind) in enumerate(self.layout):
+            self._by_name[name] = (attr_id, kind)
+            self._by_id[attr_id] = (name, width, kind)
+
+    def dumps(self, payload):
+        data = bytearray()
+        for name, value in payload.items():
+            if name == 'errors':
+                ids = [self._by_name[item][0] for item in value]
+                data.append(ERRORS_ID)
+                data.append(len(ids))
+                data.extend(ids)
+                continue
+            try:
+                attr_id, kind = self._by_name[name]
+            except KeyError:
+                raise ValueError('no binary layout for {}'.format(name))
+            data.append(attr_id)
+            if kind == 'list':
+                data.extend(value)
+            else:
+                data.append(value)
+        return bytes(data)
+
+    def loads(self, data):
+        payload = {}
+        pos = 0
+        end = len(data)
+        while pos < end:
+            attr_id = data[pos]
+            if attr_id == ERRORS_ID:
+                count = data[pos + 1]
+                payload['errors'] = {self._by_id[i][0]: 'error' for i in data[pos + 2:pos + 2 + count]}
+                pos += 2 + count
+                continue
+            try:
+                name, width, kind = self._by_id[attr_id]
+            except KeyError:
+                raise ValueError('unknown attribute id {}'.format(attr_id))
+            pos += 1
+            if pos + width > end:
+                raise ValueError('truncated value for {}'.format(name))
+            if kind == 'list':
+                payload[name] = list(data[pos:pos + width])
+            elif kind == 'bool':
+                payload[name] = data[pos] != 0
+            else:
+                payload[name] = data[pos]
+            pos += width
+        return payload
+
+
+ENCODINGS = {
+    JsonEncoding.name: JsonEncoding,
+    BinaryEncoding.name: BinaryEncoding
+}
@@ -0,0 +1,228 @@
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets, sized for BLE operations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _label_key(labels):
+    # label values are text in the exposition format, and mixed types such as None would not sort
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class Histogram:
+    """Count of observations per bucket, with their count and sum
+
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return list of (upper bound, observations at or below it), the last bound is inf
+
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'buckets': {'+Inf' if bound == float('inf') else str(bound): count for bound, count in self.cumulative()}
+        }
+
+
+class Metrics:
+    """Thread safe registry of labelled histograms, counters and gauges
+
+    Observed from the BLE threads and exported as a dict for the metrics topic or as
+    Prometheus text.
+
+    """
+
+    def __init__(self, prefix='aquatimer', buckets=DEFAULT_BUCKETS):
+        """
+
+        :param prefix: prefix of the Prometheus metric names
+        :param buckets: upper bounds in seconds of the histogram buckets
+        """
+        self.prefix = prefix
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram
+
+        :param name: metric name e.g. 'ble_read_seconds'
+        :param value: observed value, usually seconds
+        :param labels: labels of the series
+        :return:
+        """
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            key = _label_key(labels)
+            if key not in series:
+                series[key] = Histogram(self.buckets)
+            series[key].observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter
+
+        :param name: metric name e.g. 'ble_errors_total'
+        :param amount: amount to add
+        :param labels: labels of the series
+        :return:
+        """
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Set a gauge
+
+        :param name: metric name e.g. 'command_queue_depth'
+        :param value: current value
+        :param labels: labels of the series
+        :return:
+        """
+        with self._lock:
+            self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Context manager observing the duration of its block, failures are not observed
+
+        """
+        start = time.monotonic()
+        yield
+        self.observe(name, time.monotonic() - start, **labels)
+
+    def labelled(self, **labels):
+        """Return a view adding labels to everything recorded through it
+
+        :param labels: labels e.g. device='spray_mist_a19e'
+        :return: LabelledMetrics
+        """
+        return LabelledMetrics(self, labels)
+
+    def as_dict(self):
+        """Return all series as a JSON serialisable dict of metric name to list of series
+
+        """
+        with self._lock:
+            result = {}
+            for name, series in self.histograms.items():
+                result[name] = [dict(histogram.as_dict(), labels=dict(key)) for key, histogram in series.items()]
+            for kind in (self.counters, self.gauges):
+                for name, series in kind.items():
+                    result[name] = [{'labels': dict(key), 'value': value} for key, value in series.items()]
+            return result
+
+    def prometheus(self):
+        """Return all series in the Prometheus text exposition format
+
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.histograms.items()):
+                full_name = '{}_{}'.format(self.prefix, name)
+                lines.append('# TYPE {} histogram'.format(full_name))
+                for key, histogram in sorted(series.items()):
+                    for bound, count in histogram.cumulative():
+                        le = '+Inf' if bound == float('inf') else repr(float(bound))
+                        lines.append('{}_bucket{} {}'.format(full_name, _format_labels(key, [('le', le)]), count))
+                    lines.append('{}_sum{} {}'.format(full_name, _format_labels(key), histogram.sum))
+                    lines.append('{}_count{} {}'.format(full_name, _format_labels(key), histogram.count))
+            for kind, metric_type in ((self.counters, 'counter'), (self.gauges, 'gauge')):
+                for name, series in sorted(kind.items()):
+                    full_name = '{}_{}'.format(self.prefix, name)
+                    lines.append('# TYPE {} {}'.format(full_name, metric_type))
+                    for key, value in sorted(series.items()):
+                        lines.append('{}{} {}'.format(full_name, _format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+    async def serve_prometheus(self, port, host='127.0.0.1', before_scrape=None):
+        """Serve the Prometheus text format over HTTP on a local port
+
+        :param port: TCP port
+        :param host: address to listen on
+        :param before_scrape: optional function called before each scrape, e.g. to update gauges
+        :return: asyncio server
+        """
+
+        async def handle(reader, writer):
+            try:
+                # the path is ignored, every request gets the metrics
+                while (await reader.readline()).strip():
+                    pass
+                if before_scrape:
+                    before_scrape()
+                body = self.prometheus().encode('utf-8')
+                writer.write(
+                    b'HTTP/1.0 200 OK\r\n'
+                    b'Content-Type: text/plain; version=0.0.4\r\n'
+                    b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body
+                )
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+class LabelledMetrics:
+    """View of a Metrics registry adding labels to everything recorded through it
+
+    """
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def _merge(self, labels):
+        merged = dict(self.labels)
+        merged.update(labels)
+        return merged
+
+    def observe(self, name, value, **labels):
+        self.metrics.observe(name, value, **self._merge(labels))
+
+    def inc(self, name, amount=1, **labels):
+        self.metrics.inc(name, amount, **self._merge(labels))
+
+    def set(self, name, value, **labels):
+        self.metrics.set(name, value, **self._merge(labels))
+
+    def time(self, name, **labels):
+        return self.metrics.time(name, **self._merge(labels))
+
+    def labelled(self, **labels):
+        return LabelledMetrics(self.metrics, self._merge(labels))
@@ -1,96 +1,406 @@
 import asyncio
+import functools
 import json
 import logging
+import re
+import time
 import Adafruit_BluefruitLE
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from .timer import TimerService
+from .addresses import AddressCache, DEFAULT_ADDRESS_CACHE, find_cached_devices, scan_devices
+from .commands import CommandQueue, PRIORITY_GET, PRIORITY_POLL, PRIORITY_SET
+from .connection import ConnectionManager, LinkLostError
+from .discovery import (
+    DEFAULT_DISCOVERY_CACHE, DiscoveryCache, firmware_revision, service_layout, wait_for_services)
+from .encoding import ENCODINGS
+from .metrics import Metrics
+from .polling import PollScheduler
+from .timer import ProgramResult, TimerService
 from hbmqtt.client import MQTTClient
 from hbmqtt.mqtt.constants import QOS_1
 
 ble = Adafruit_BluefruitLE.get_provider()  # Get the BLE provider for the current platform.
 
 
+def device_id_from_name(name):
+    """Build a topic safe device id from a device name e.g. "Spray-Mist A19E" -> "spray_mist_a19e"
+
+    :param name: device name
+    :return:
+    """
+    return re.sub('[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+class TimerDevice:
+    """State of one timer managed by the MQTT service
+
+    """
+
+    def __init__(self, device_id, name, queue_size=100, metrics=None, poll_policies=None):
+        self.device_id = device_id
+        self.name = name
+        self.metrics = metrics
+        self.device = None
+        # found by a cached address that has not connected yet
+        self.address_unverified = False
+        self.connection = None
+        self.timer_service = None
+        self.command_queue = CommandQueue(maxsize=queue_size, metrics=metrics)
+        self.poll_scheduler = PollScheduler(poll_policies)
+        # writes waiting for the coalesce window to close, last value wins
+        self.pending_sets = OrderedDict()
+        self.flush_handle = None
+        # last value published on each attribute topic
+        self.published = {}
+        # publish a full snapshot with the next update
+        self.snapshot_due = True
+        # cleared while the device is unreachable, commands wait for it
+        self.link_up = asyncio.Event()
+        self.link_up.set()
+        self.link_lost_at = None
+        self.clock_synced_at = None
+        # seconds spent running BLE functions, to measure the BLE time of each command
+        self.ble_seconds = 0.0
+
+    def __repr__(self):
+        return '<TimerDevice {} "{}">'.format(self.device_id, self.name)
+
+
 class TimerMqttService:
-    """MQTT Service for Bluetooth LE Aqua Systems water timer
+    """MQTT Service for Bluetooth LE Aqua Systems water timers
+
+    Manages one or more timers sharing a single MQTT client and BLE adapter, each timer
+    has its own topics under TOPIC_PREFIX/<device id>/ and its own command queue.
 
     """
 
-    COMMAND_TOPIC = '$SYS/broker/aquatimer/command'
-    INFO_TOPIC = '$SYS/broker/aquatimer/info'
-    BATTERY_TOPIC = '$SYS/broker/aquatimer/battery'
+    TOPIC_PREFIX = 'aquatimer'
+
+    # Topic names under the device topic
+    COMMAND_TOPIC = 'command'
+    INFO_TOPIC = 'info'
+    BATTERY_TOPIC = 'battery'
+    META_TOPIC = 'meta'
+    PROGRAM_TOPIC = 'program'
+    RESPONSE_TOPIC = 'response'
+    # Service wide topic under TOPIC_PREFIX
+    METRICS_TOPIC = 'metrics'
 
-    # Dictionary for any attribute specific topics
+    # Dictionary for any attribute specific topic names, other attributes use their name
     ATTR_TOPICS = {
         'battery': BATTERY_TOPIC
     }
 
     device_connect_timeout = 10  # seconds
-    battery_notify_interval = 1  # minutes
+    poll_policies = None  # dict of attribute name to PollPolicy, None for DEFAULT_POLL_POLICIES
+    poll_check_interval = 5  # seconds between checks for attributes due to be polled
+    clock_sync_interval = 6 * 3600  # seconds between reads of the device clock, None to never read it again
+    clock_drift_threshold = 30  # seconds the device clock may be off before it is set to local time
+    cache_ttl = None  # seconds per attribute, None for TimerService.CACHE_TTL
+    max_ble_workers = 4  # threads shared by all devices
+    idle_disconnect = 30  # seconds to keep an unused device connected, None to stay connected
+    max_connections = None  # devices connected at once, None for no limit
+    set_coalesce_window = 0.5  # seconds to collect set commands before writing them
+    command_queue_size = 100  # commands waiting per device, background polls are dropped when full
+    payload_encoding = 'json'  # 'json' or 'binary', announced on the meta topic
+    metrics_interval = 60  # seconds between publishes on the metrics topic, None to not publish
+    prometheus_port = None  # local port to serve Prometheus metrics on, None to not serve
+    address_cache_path = DEFAULT_ADDRESS_CACHE  # device name to address cache file, None to always scan
+    scan_timeout = 60  # seconds to scan for devices
+    discovery_cache_path = DEFAULT_DISCOVERY_CACHE  # GATT layout cache file, None to always discover
+    reconnect_min_delay = 1  # seconds before retrying a lost device, doubled after each failure
+    reconnect_max_delay = 60  # longest wait in seconds between reconnect attempts
+
+    def __init__(self, mqtt_url, device_names, start=True, provider=None):
+        """
 
-    def __init__(self, mqtt_url, device_name):
+        :param mqtt_url: URL of the MQTT broker
+        :param device_names: device name, list of device names or dict of device id to device name
+        :param start: start the service straight away
+        :param provider: optional BLE provider, defaults to the provider for the current platform
+        """
 
         self.logger = logging.getLogger(__name__)
         self.running = True
-        self.device = None
-        self.timer_service = None
+        self.ble = ble if provider is None else provider
         self.mqtt_url = mqtt_url
         self.mqtt_client = MQTTClient()
-        self.device_name = device_name
+        self.encoding = ENCODINGS[self.payload_encoding]()
+        self.metrics = Metrics(prefix=self.TOPIC_PREFIX)
+        self.address_cache = AddressCache(self.address_cache_path) if self.address_cache_path else None
+        self.discovery_cache = DiscoveryCache(self.discovery_cache_path) if self.discovery_cache_path else None
         self.loop = asyncio.get_event_loop()
 
-        self.command_queue = asyncio.Queue(loop=self.loop)
+        if isinstance(device_names, str):
+            device_names = [device_names]
+        if not isinstance(device_names, dict):
+            device_names = OrderedDict((device_id_from_name(name), name) for name in device_names)
+        self.devices = OrderedDict(
+            (device_id, TimerDevice(
+                device_id, name, self.command_queue_size, self.metrics.labelled(device=device_id), self.poll_policies))
+            for device_id, name in device_names.items()
+        )
+
+        # all GATT operations run on these threads so they never block the event loop,
+        # commands for one device are processed in order so only one runs per device
+        workers = max(1, min(len(self.devices), self.max_ble_workers))
+        self.ble_executor = ThreadPoolExecutor(max_workers=workers)
+        # shared by the bulk reads of all devices
+        self.read_executor = ThreadPoolExecutor(max_workers=workers * TimerService.max_reads_in_flight)
+
+        # devices are connected when first used and disconnected once idle
+        self.connections = ConnectionManager(
+            idle_timeout=self.idle_disconnect,
+            max_connections=self.max_connections,
+            connect_timeout=self.device_connect_timeout
+        )
+
+        if start:
+            self.start()
 
-        ble.run_mainloop_with(self.run)
+    @property
+    def queue_stats(self):
+        """Return dict of command queue depth and wait time metrics per device id
+
+        """
+        return {device_id: timer.command_queue.stats for device_id, timer in self.devices.items()}
+
+    def topic(self, timer, name):
+        """Build the full topic for a device
+
+        :param timer: TimerDevice
+        :param name: topic name e.g. INFO_TOPIC
+        :return:
+        """
+        return '{}/{}/{}'.format(self.TOPIC_PREFIX, timer.device_id, name)
+
+    def start(self):
+        """Start the BLE mainloop and run the service
+
+        """
+        self.ble.run_mainloop_with(self.run)
 
     def run(self):
+        if not self.setup_ble():
+            return None
+
+        # now do things
+        self._run_mqtt()
+
+    def setup_ble(self):
+        """Initialise the BLE adapter and find the devices, blocking
+
+        :return: True if the adapter is ready, devices that were not found are logged
+        """
         # Initialize the BLE system.  MUST be called before other BLE calls!
-        ble.initialize()
+        self.ble.initialize()
 
+        names = [timer.name for timer in self.devices.values()]
         try:
-            # Clear any cached data because both bluez and CoreBluetooth have issues with
-            # caching data and it going stale.
-            ble.clear_cached_data()
+            # devices the provider still knows from their cached address need no scan
+            cached = {}
+            if self.address_cache:
+                cached = find_cached_devices(self.ble, self.address_cache, names)
+
+            if not cached:
+                # Clear any cached data because both bluez and CoreBluetooth have issues with
+                # caching data and it going stale. This also forgets the known devices.
+                self.ble.clear_cached_data()
 
             # Get the first available BLE network adapter and make sure it's powered on.
-            adapter = ble.get_default_adapter()
+            adapter = self.ble.get_default_adapter()
             adapter.power_on()
             self.logger.debug('Using adapter: {0}'.format(adapter.name))
 
             # Disconnect any currently connected UART devices.  Good for cleaning up and
             # starting from a fresh state.
             self.logger.debug('Disconnecting any connected Timer devices...')
-            TimerService.disconnect_devices()
+            self.ble.disconnect_devices(TimerService.ADVERTISED)
         except Exception as e:
             self.logger.error("got error: {}".format(e))
-            return None
+            return False
+
+        # one scan pass for all devices without a known address
+        missing = [name for name in names if name not in cached]
+        found = {}
+        if missing:
+            self.logger.debug('Searching for {}...'.format(missing))
+            try:
+                found = scan_devices(self.ble, adapter, missing, self.scan_timeout)
+            except Exception as e:
+                self.logger.error("scan error: {}".format(e))
 
-        # Scan for device
-        self.logger.debug('Searching for Timer device...')
+        for timer in self.devices.values():
+            if timer.name in cached:
+                self.logger.debug('{} found by cached address'.format(timer))
+                self._add_timer(timer, cached[timer.name], from_cache=True)
+            elif timer.name in found:
+                self._add_timer(timer, found[timer.name])
+            else:
+                self.logger.error("{} error: Failed to find Timer device!".format(timer))
+        self._save_cache(self.address_cache)
+        return True
+
+    def _add_timer(self, timer, device, from_cache=False):
+        """Register a found device with the connection manager
+
+        :param timer: TimerDevice
+        :param device: BLE device
+        :param from_cache: True if found by its cached address, it is scanned for if it fails to connect
+        :return:
+        """
+        timer.device = device
+        timer.address_unverified = from_cache
+        if self.address_cache:
+            self.address_cache.set(timer.name, device.id)
+        timer.connection = self.connections.add(
+            timer.device,
+            on_connect=functools.partial(self._setup_timer, timer),
+            on_disconnect=functools.partial(self._teardown_timer, timer),
+            metrics=timer.metrics
+        )
+
+    def _save_cache(self, cache):
+        if not cache:
+            return
         try:
-            adapter.start_scan()
-            # Search for the first UART device found (will time out after 60 seconds
-            # but you can specify an optional timeout_sec parameter to change it).
-            self.device = ble.find_device(name=self.device_name)
-            if self.device is None:
-                raise RuntimeError('Failed to find Timer device!')
-        finally:
-            # Make sure scanning is stopped before exiting.
-            adapter.stop_scan()
+            cache.save()
+        except OSError as e:
+            self.logger.error("cache error: {}".format(e))
 
-        self.logger.debug('Connecting to device...')
-        self.device.connect()
+    def _verify_address(self, timer):
+        """Connect to a device found by its cached address, scanning for it by name once if that fails
 
+        :param timer: TimerDevice
+        :return:
+        """
         try:
+            self.connections.acquire(timer.connection)
+        except Exception as e:
+            self.logger.debug('{} connect by cached address failed, scanning: {}'.format(timer, e))
+            # the adapter keeps listing known devices out of range, so the cached address is skipped
+            # to find a replacement, but only for this scan
+            device = scan_devices(self.ble, self.ble.get_default_adapter(), [timer.name],
+                                  self.scan_timeout, ignore=[timer.device.id]).get(timer.name)
+            # scanning on every reconnect attempt would tie up a BLE worker, a device briefly out of
+            # range is reconnected at its cached address by the retries
+            timer.address_unverified = False
+            if device is None:
+                raise
+            timer.device = device
+            timer.connection.device = device
+            self.address_cache.set(timer.name, device.id)
+            self._save_cache(self.address_cache)
+        else:
+            self.connections.release(timer.connection)
+        timer.address_unverified = False
+
+    def _setup_timer(self, timer):
+        """Set up the timer service once a device is connected, called from the BLE thread
+
+        :param timer: TimerDevice
+        :return:
+        """
+        if timer.timer_service is not None and timer.timer_service.device is not timer.device:
+            # the device was found again by a scan
+            timer.timer_service.device = timer.device
+
+        # discovery is skipped when the layout of this device and firmware is cached
+        if not self._bind_cached(timer):
             self.logger.debug('Discovering services...')
-            TimerService.discover(self.device)
+            with timer.metrics.time('ble_discover_seconds'):
+                TimerService.discover(timer.device)
+            self._bind_timer(timer, discovered=True)
+            self._store_discovery(timer)
+
+        try:
+            self.logger.debug('Subscribing to notifications...')
+            timer.timer_service.start_notify(functools.partial(self._on_notify, timer))
+        except Exception as e:
+            # fall back to polling everything
+            self.logger.error("notify error: {}".format(e))
 
+        self.logger.debug('{} connect stats: {}'.format(timer, timer.connection.stats.as_dict()))
+
+    def _bind_timer(self, timer, discovered):
+        """Create the timer service, or find the characteristics of the new connection keeping its cache
+
+        :param timer: TimerDevice
+        :param discovered: False if service discovery was skipped
+        :return:
+        """
+        if timer.timer_service is None:
             self.logger.debug('Creating device')
-            self.timer_service = TimerService(self.device)
+            timer.timer_service = TimerService(
+                timer.device, cache_ttl=self.cache_ttl, executor=self.read_executor, metrics=timer.metrics,
+                discovered=discovered)
+        else:
+            timer.timer_service.discovered = discovered
+            timer.timer_service.rebind()
+
+    def _bind_cached(self, timer):
+        """Bind the timer service without discovery if the device layout is cached
+
+        :param timer: TimerDevice
+        :return: True if bound from the cache
+        """
+        if not self.discovery_cache:
+            return False
+        address = timer.device.id
+        # services resolve a while after connecting, the firmware revision is only readable then
+        if not wait_for_services(timer.device, TimerService.SERVICES, self.device_connect_timeout):
+            self.logger.debug('{} services not resolved, discovering'.format(timer))
+            timer.metrics.inc('discovery_cache_misses_total')
+            return False
+        try:
+            services = self.discovery_cache.lookup(address, firmware_revision(timer.device))
+            if services is None:
+                timer.metrics.inc('discovery_cache_misses_total')
+                return False
+            expected = {str(attr['uuid']) for attr in TimerService.ATTRIBUTES.values()}
+            if not expected.issubset(uuid for uuids in services.values() for uuid in uuids):
+                raise RuntimeError('cached layout is missing characteristics')
+            self._bind_timer(timer, discovered=False)
         except Exception as e:
-            self.logger.error("got error: {}".format(e))
+            self.logger.debug('{} cached discovery failed: {}'.format(timer, e))
+            self.discovery_cache.remove(address)
+            self._save_cache(self.discovery_cache)
+            timer.metrics.inc('discovery_cache_misses_total')
+            return False
+        self.logger.debug('{} bound from the discovery cache'.format(timer))
+        timer.metrics.inc('discovery_cache_hits_total')
+        return True
 
-        # now do things
-        self._run_mqtt()
+    def _store_discovery(self, timer):
+        """Remember the layout of a discovered device
+
+        :param timer: TimerDevice
+        :return:
+        """
+        if not self.discovery_cache:
+            return
+        try:
+            firmware = firmware_revision(timer.device)
+        except Exception as e:
+            self.logger.debug('{} firmware revision error: {}'.format(timer, e))
+            firmware = None
+        if self.discovery_cache.store(
+                timer.device.id, firmware, service_layout(timer.device, TimerService.SERVICES)):
+            self._save_cache(self.discovery_cache)
+
+    def _teardown_timer(self, timer):
+        """Unsubscribe from notifications before a device disconnects, called from the BLE thread
+
+        :param timer: TimerDevice
+        :return:
+        """
+        if timer.timer_service and timer.timer_service.notifying:
+            try:
+                timer.timer_service.stop_notify()
+            except Exception as e:
+                self.logger.debug("stop notify error: {}".format(e))
+            timer.timer_service.notifying = False
 
     def stop(self):
         """Stop the service
@@ -98,136 +408,785 @@ class TimerMqttService:
         """
         self.running = False
 
-    async def process_command(self, command):
+    async def run_ble(self, timer, func, *args):
+        """Run a blocking BLE function for a device on the BLE executor, connecting if needed
+
+        The executor has up to max_ble_workers threads shared by all devices, calls for one
+        device are serialised by its consumer, calls for different devices may overlap.
+
+        :param timer: TimerDevice
+        :param func: function to run
+        :param args: arguments for the function
+        :return: awaitable result of the function
+        """
+        return await self.loop.run_in_executor(
+            self.ble_executor, functools.partial(self._run_connected, timer, func, *args)
+        )
+
+    def _run_connected(self, timer, func, *args):
+        start = time.monotonic()
+        try:
+            if timer.connection is None:
+                return func(*args)
+            self._acquire(timer)
+            try:
+                return func(*args)
+            except Exception as e:
+                if not self._device_connected(timer):
+                    self.connections.mark_lost(timer.connection)
+                    raise LinkLostError('{} connection lost: {}'.format(timer, e)) from e
+                raise
+            finally:
+                self.connections.release(timer.connection)
+        finally:
+            timer.ble_seconds += time.monotonic() - start
+
+    def _acquire(self, timer):
+        """Connect the device if needed and mark it in use, blocking
+
+        :param timer: TimerDevice
+        :return:
+        :raises LinkLostError: if the device could not be connected
+        """
+        try:
+            if timer.address_unverified and not timer.connection.connected:
+                self._verify_address(timer)
+            self.connections.acquire(timer.connection)
+        except Exception as e:
+            raise LinkLostError('{} connect failed: {}'.format(timer, e)) from e
+
+    @staticmethod
+    def _device_connected(timer):
+        return getattr(timer.device, 'is_connected', True)
+
+    async def process_command(self, timer, command):
         """Process a command
 
+        :param timer: TimerDevice
         :param command:
         :return:
         """
-        self.logger.debug("processing command: {}".format(command))
+        self.logger.debug("processing command for {}: {}".format(timer, command))
 
+        start = self.loop.time()
         try:
-            if not self.timer_service:
+            if command['cmd'] == 'batch':
+                await self.process_batch(timer, command)
+            elif not timer.connection and not timer.timer_service:
                 self.logger.debug("No device found")
                 return
-
-            if command['cmd'] == 'set':
-                setattr(self.timer_service, command['item'], command['value'])
-                # make sure we push an update
-                data = {'cmd': 'get', 'item': 'all'}
-                await self.command_queue.put(data)
-            elif command['cmd'] == 'get':
-                await self.publish_item(command['item'])
+            else:
+                await self._run_command(timer, command)
+        except LinkLostError as e:
+            self.logger.warning(str(e))
+            self._link_lost(timer)
+            # run the command again once the device is back
+            self._requeue(timer, command)
+            return
         except Exception as e:
             self.logger.error('publish error: {}'.format(e))
+            timer.metrics.inc('command_errors_total', cmd=command.get('cmd'))
+            return
+        timer.metrics.observe('command_seconds', self.loop.time() - start, cmd=command.get('cmd'))
+
+    async def program(self, timer, schedule, rollback=True):
+        """Write a watering program, publishing the outcome as JSON on the program topic
+
+        Only attributes that differ from their last published values are written, see TimerService.program.
+        A program with invalid values is answered without connecting to the device.
+
+        :param timer: TimerDevice
+        :param schedule: dict of attribute name to value
+        :param rollback: restore the previous values if the program is not fully applied
+        :return: ProgramResult
+        """
+        result = ProgramResult()
+        if isinstance(schedule, dict):
+            result.failed = TimerService.encode_program(schedule)[1]
+        else:
+            result.failed = {'value': 'program value must be an object of attribute values'}
+        if result.applied:
+            result = await self.run_ble(timer, self._program, timer, schedule, rollback)
+        if not result.applied:
+            self.logger.error('{} program not applied: {}'.format(timer, result.failed))
+        await self.publish_values(timer, result.values)
+        await self.mqtt_client.publish(
+            self.topic(timer, TimerMqttService.PROGRAM_TOPIC),
+            json.dumps(result.as_dict()).encode("utf-8"),
+            qos=QOS_1
+        )
+        return result
+
+    def _program(self, timer, schedule, rollback):
+        result = timer.timer_service.program(schedule, known=timer.published, rollback=rollback)
+        if not result.applied and not self._device_connected(timer):
+            # run the whole program again once the device is back
+            raise RuntimeError('program interrupted: {}'.format(result.failed))
+        return result
 
-    async def publish_item(self, item):
-        """Publish an item to the relevant item topic or info topic as fallback
+    async def sync_clock(self, timer):
+        """Read the device clock, setting it to local time if it drifted past clock_drift_threshold
 
-        :param item:
+        :param timer: TimerDevice
         :return:
         """
+        offset = await self.run_ble(timer, self._sync_clock, timer)
+        timer.metrics.set('device_clock_offset_seconds', offset)
+        timer.metrics.set('device_clock_drift', timer.timer_service.clock_model.drift)
+        await self.publish_item(timer, 'time', changed_only=True)
 
-        topic = TimerMqttService.INFO_TOPIC
-        if item == 'all':
-            # check if we want the all attributes
-            payload = self.timer_service.all
+    def _sync_clock(self, timer):
+        return timer.timer_service.sync_clock(self.clock_drift_threshold)
+
+    async def _run_command(self, timer, command):
+        """Run a single command
+
+        :param timer: TimerDevice
+        :param command: command dict
+        :return: ProgramResult for program commands, otherwise None
+        """
+        if command['cmd'] == 'set':
+            self._queue_set(timer, command['item'], command['value'])
+        elif command['cmd'] == 'flush':
+            await self.flush_sets(timer)
+        elif command['cmd'] == 'get':
+            # make sure reads see any writes still waiting
+            if timer.pending_sets:
+                await self.flush_sets(timer)
+            errors = await self.publish_item(timer, command['item'], changed_only=command.get('poll', False))
+            if not isinstance(command['item'], list) and command['item'] in errors:
+                raise ValueError('{} {}'.format(command['item'], errors[command['item']]))
+        elif command['cmd'] == 'sync_clock':
+            await self.sync_clock(timer)
+        elif command['cmd'] == 'program':
+            if timer.pending_sets:
+                await self.flush_sets(timer)
+            return await self.program(timer, command['value'], command.get('rollback', True))
         else:
-            # otherwise just return one attribute
-            payload = {
-                item: getattr(self.timer_service, item)
-            }
-            # check if we need to send to a specific topic
-            if item in TimerMqttService.ATTR_TOPICS:
-                topic = TimerMqttService.ATTR_TOPICS[item]
+            raise ValueError('unknown command {}'.format(command['cmd']))
+
+    async def process_batch(self, timer, batch):
+        """Run a batch of commands in order on one connection, then publish one ack on the response topic
+
+        Each command in the ack has its correlation id, whether it succeeded and the seconds it
+        took in total and on the BLE thread. Set commands in a row of different items are written
+        together, each reports the time of the shared write and its own outcome, an invalid value
+        fails that command only. If the device drops out the commands that ran
+        keep their results and the rest run once it is back.
+
+        :param timer: TimerDevice
+        :param batch: batch command dict with a list of commands
+        :return:
+        """
+        commands = batch['commands']
+        results = batch.setdefault('results', [])
+        if not timer.connection and not timer.timer_service:
+            results.extend(self._ack(command, 'no device found') for command in commands)
+            del commands[:]
+        elif commands:
+            if timer.connection is not None:
+                # connect once for the whole batch
+                await self.loop.run_in_executor(self.ble_executor, self._acquire, timer)
+            try:
+                while commands:
+                    # set commands in a row are written together, a later set of the same item starts a
+                    # new write so each command gets the result of its own value
+                    count = 1
+                    if commands[0].get('cmd') == 'set':
+                        items = {commands[0].get('item')}
+                        while count < len(commands) and commands[count].get('cmd') == 'set' and \
+                                commands[count].get('item') not in items:
+                            items.add(commands[count].get('item'))
+                            count += 1
+                    start = self.loop.time()
+                    ble_start = timer.ble_seconds
+                    outcomes = await self._run_batch_commands(timer, commands[:count])
+                    seconds = self.loop.time() - start
+                    ble_seconds = timer.ble_seconds - ble_start
+                    for command, (error, result) in zip(commands[:count], outcomes):
+                        results.append(self._ack(command, error, result, seconds, ble_seconds))
+                    del commands[:count]
+            finally:
+                if timer.connection is not None:
+                    await self.loop.run_in_executor(self.ble_executor, self.connections.release, timer.connection)
+
+        await self.mqtt_client.publish(
+            self.topic(timer, TimerMqttService.RESPONSE_TOPIC),
+            json.dumps({'results': results}).encode("utf-8"),
+            qos=QOS_1
+        )
+
+    async def _run_batch_commands(self, timer, commands):
+        """Run one command, or several set commands written together
+
+        :param timer: TimerDevice
+        :param commands: list of command dicts
+        :return: list of (error or None, result) per command
+        """
+        try:
+            if commands[0].get('cmd') == 'set':
+                # invalid sets are answered straight away, the others are written together
+                checks = [self._check_set(command) for command in commands]
+                for command, error in zip(commands, checks):
+                    if error is None:
+                        self._queue_set(timer, command['item'], command['value'])
+                    else:
+                        timer.metrics.inc('command_errors_total', cmd='set')
+                errors = {}
+                written = await self.flush_sets(timer, errors) if None in checks else []
+                outcomes = []
+                for command, error in zip(commands, checks):
+                    if error is None and command['item'] not in written:
+                        error = errors.get(command['item'], 'not written')
+                    outcomes.append((error, None))
+                return outcomes
+
+            result = await self._run_command(timer, commands[0])
+            if result is not None and not result.applied:
+                return [('not applied', result)]
+            return [(None, result)]
+        except LinkLostError:
+            raise
+        except Exception as e:
+            timer.metrics.inc('command_errors_total', cmd=commands[0].get('cmd'))
+            return [(str(e) or type(e).__name__, None)] * len(commands)
+
+    @staticmethod
+    def _check_set(command):
+        """Validate a set command before it is queued
+
+        :param command: command dict
+        :return: reason the command can not be written, or None
+        """
+        item = command.get('item')
+        attr = TimerService.ATTRIBUTES.get(item)
+        if not attr or not attr['can_set']:
+            return '{} can not be set'.format(item)
+        if 'value' not in command:
+            return 'missing value'
+        try:
+            TimerService.CODECS[item].encode(command['value'])
+        except (ValueError, TypeError) as e:
+            return str(e) or type(e).__name__
+        return None
+
+    @staticmethod
+    def _ack(command, error, result=None, seconds=None, ble_seconds=None):
+        """Build the ack of one command in a batch
+
+        """
+        ack = {
+            'id': command.get('id'),
+            'cmd': command.get('cmd'),
+            'ok': error is None,
+            'seconds': seconds,
+            'ble_seconds': ble_seconds
+        }
+        if 'item' in command:
+            ack['item'] = command['item']
+        if error is not None:
+            ack['error'] = error
+        if result is not None:
+            ack['result'] = result.as_dict()
+        return ack
+
+    @staticmethod
+    def command_priority(command):
+        """Return the queue priority of a command, a batch runs at the highest priority of its commands
+
+        :param command: command dict
+        :return: one of the PRIORITY values
+        """
+        if command.get('cmd') == 'batch':
+            return min((TimerMqttService.command_priority(c) for c in command['commands']), default=PRIORITY_GET)
+        if command.get('cmd') in ('set', 'flush', 'program'):
+            return PRIORITY_SET
+        if command.get('poll'):
+            return PRIORITY_POLL
+        return PRIORITY_GET
+
+    def _requeue(self, timer, command):
+        """Put a command back on the queue, without waiting
+
+        :param timer: TimerDevice
+        :param command: command dict
+        :return:
+        """
+        try:
+            timer.command_queue.put_nowait(command, self.command_priority(command))
+        except asyncio.QueueFull:
+            self.logger.error("{} queue full, dropped {}".format(timer, command))
+
+    def _link_lost(self, timer):
+        """Hold commands for a device that became unreachable and start reconnecting
+
+        :param timer: TimerDevice
+        :return:
+        """
+        if not timer.link_up.is_set():
+            return
+        timer.link_up.clear()
+        timer.link_lost_at = self.loop.time()
+        timer.metrics.inc('link_lost_total')
+        if timer.timer_service:
+            # notifications stopped with the connection
+            timer.timer_service.notifying = False
+        asyncio.ensure_future(self._reconnect(timer))
+
+    async def _reconnect(self, timer):
+        """Reconnect a lost device with exponential backoff, then read what may have changed
+
+        :param timer: TimerDevice
+        :return:
+        """
+        delay = self.reconnect_min_delay
+        attempts = 0
+        while self.running:
+            attempts += 1
+            try:
+                await self.loop.run_in_executor(self.ble_executor, self._connect_device, timer)
+                break
+            except Exception as e:
+                self.logger.debug("{} reconnect attempt {} failed: {}".format(timer, attempts, e))
+                timer.metrics.inc('reconnect_failures_total')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.reconnect_max_delay)
+
+        recovered = self.loop.time() - timer.link_lost_at
+        self.logger.info("{} reconnected after {:.1f}s and {} attempts".format(timer, recovered, attempts))
+        timer.metrics.observe('link_recovery_seconds', recovered)
+        # published with the resync
+        timer.snapshot_due = True
+        try:
+            await self.resync(timer)
+        except LinkLostError as e:
+            self.logger.warning(str(e))
+            asyncio.ensure_future(self._reconnect(timer))
+            return
+        except Exception as e:
+            self.logger.error('{} resync error: {}'.format(timer, e))
+        timer.link_up.set()
+
+    def _connect_device(self, timer):
+        self.connections.acquire(timer.connection)
+        self.connections.release(timer.connection)
+
+    async def resync(self, timer):
+        """Read the attributes that may have changed while a device was unreachable, publishing changes
+
+        Attributes that only change when written keep their last known values.
+
+        :param timer: TimerDevice
+        :return:
+        """
+        await self.publish_item(timer, TimerService.VOLATILE_ATTRIBUTES, fresh=True, changed_only=True)
+
+    def _queue_set(self, timer, item, value):
+        """Hold a write until the coalesce window closes, replacing any earlier write of the item
+
+        :param timer: TimerDevice
+        :param item: name of item
+        :param value:
+        :return:
+        """
+        timer.pending_sets.pop(item, None)
+        timer.pending_sets[item] = value
+        if timer.flush_handle is None:
+            timer.flush_handle = self.loop.call_later(self.set_coalesce_window, self._queue_flush, timer)
+
+    def _queue_flush(self, timer):
+        """Queue the write of pending set commands once the coalesce window closes
+
+        :param timer: TimerDevice
+        :return:
+        """
+        data = {'cmd': 'flush'}
+        try:
+            timer.command_queue.put_nowait(data, PRIORITY_SET)
+        except asyncio.QueueFull:
+            asyncio.ensure_future(timer.command_queue.put(data, PRIORITY_SET))
+
+    async def flush_sets(self, timer, errors=None):
+        """Write the pending set commands and publish one refresh of the written attributes
+
+        :param timer: TimerDevice
+        :param errors: optional dict to add the reason each failed write failed to, by item name
+        :return: list of items written
+        """
+        if timer.flush_handle:
+            timer.flush_handle.cancel()
+            timer.flush_handle = None
+        writes, timer.pending_sets = timer.pending_sets, OrderedDict()
+        if not writes:
+            return []
+
+        try:
+            written = await self.run_ble(timer, self._write_items, timer, writes, errors)
+        except LinkLostError:
+            # keep the writes not made yet, unless a newer set command replaced them
+            for item, value in writes.items():
+                timer.pending_sets.setdefault(item, value)
+            raise
+
+        # re-read what was written plus anything it affects
+        refresh = []
+        for item in written:
+            for attr in [item] + TimerService.DEPENDENT_ATTRIBUTES.get(item, []):
+                if attr not in refresh:
+                    refresh.append(attr)
+        if refresh:
+            await self.publish_item(timer, refresh, fresh=True, changed_only=True)
+        return written
+
+    async def publish_item(self, timer, item, fresh=False, changed_only=False):
+        """Publish an item to its attribute topic, 'all' also publishes a snapshot to the info topic
+
+        :param timer: TimerDevice
+        :param item: name of item, 'all' or list of names
+        :param fresh: bypass the cache and read from the device
+        :param changed_only: only publish values that changed, for background updates
+        :return: dict of errors of the attributes that could not be read
+        """
+        values, errors = await self.run_ble(timer, self._read_item, timer, item, fresh)
+        await self.publish_values(timer, values, changed_only=changed_only)
+
+        # full snapshot when asked for, or once all values are known if consumers may have missed updates
+        if (item == 'all' and not changed_only) or (
+                timer.snapshot_due and all(attr in timer.published for attr in TimerService.ATTRIBUTES)):
+            await self.publish_snapshot(timer, errors)
+        return errors
+
+    async def publish_values(self, timer, values, changed_only=True):
+        """Publish values to their retained attribute topics
+
+        :param timer: TimerDevice
+        :param values: dict of item name to value
+        :param changed_only: skip values equal to the last ones published
+        :return:
+        """
+        # fresh values put off the next poll of their attributes
+        timer.poll_scheduler.seen(values)
+        for item, value in values.items():
+            if changed_only and item in timer.published and timer.published[item] == value:
+                continue
+            topic = self.topic(timer, TimerMqttService.ATTR_TOPICS.get(item, item))
+            await self.publish(topic, {item: value}, retain=True)
+            timer.published[item] = value
+
+    async def publish_snapshot(self, timer, errors=None):
+        """Publish all last known values to the info topic
+
+        :param timer: TimerDevice
+        :param errors: optional dict of attributes that failed to read
+        :return:
+        """
+        payload = dict(timer.published)
+        if errors:
+            payload['errors'] = errors
+        await self.publish(self.topic(timer, TimerMqttService.INFO_TOPIC), payload)
+        timer.snapshot_due = False
+
+    def _write_items(self, timer, writes, errors=None):
+        """Write items to the device, blocking
+
+        :param timer: TimerDevice
+        :param writes: dict of item name to value, items are removed once handled
+        :param errors: optional dict to add the reason each failed write failed to, by item name
+        :return: list of items written
+        """
+        errors = {} if errors is None else errors
+        written = []
+        for item in list(writes):
+            value = writes[item]
+            attr = TimerService.ATTRIBUTES.get(item)
+            if not attr or not attr['can_set']:
+                self.logger.error("{} can not be set".format(item))
+                errors[item] = '{} can not be set'.format(item)
+                del writes[item]
+                continue
+            try:
+                setattr(timer.timer_service, item, value)
+                written.append(item)
+            except Exception as e:
+                if not self._device_connected(timer):
+                    # leave this and the remaining writes for when the device is back
+                    raise
+                self.logger.error("set {} error: {}".format(item, e))
+                errors[item] = str(e) or type(e).__name__
+            del writes[item]
+        return written
+
+    def _read_item(self, timer, item, fresh=False):
+        """Read an item from the device, blocking
+
+        :param timer: TimerDevice
+        :param item: name of item, 'all' or list of names
+        :param fresh: bypass the cache and read from the device
+        :return: tuple of dict of values and dict of errors
+        """
+        if item != 'all' and not isinstance(item, list):
+            # just return one attribute
+            if item not in TimerService.ATTRIBUTES:
+                errors = {item: 'unknown attribute'}
+                self.logger.error("{} read errors: {}".format(timer, errors))
+                return {}, errors
+            return {item: timer.timer_service.read(item, fresh=fresh)}, {}
+
+        # check if we want all or a subset of the attributes
+        unknown = {}
+        if item != 'all':
+            unknown = {name: 'unknown attribute' for name in item if name not in TimerService.ATTRIBUTES}
+            item = [name for name in item if name not in unknown]
+        snapshot = timer.timer_service.read_many(None if item == 'all' else item, fresh=fresh)
+        if snapshot.errors and not self._device_connected(timer):
+            raise RuntimeError('read failed: {}'.format(snapshot.errors))
+        snapshot.errors.update(unknown)
+        if snapshot.errors:
+            self.logger.error("{} read errors: {}".format(timer, snapshot.errors))
+        return dict(snapshot), snapshot.errors
+
+    async def publish(self, topic, payload, retain=False):
+        """Publish a payload to a topic
+
+        :param topic:
+        :param payload: dict of attribute values
+        :param retain: ask the broker to keep the last payload for new subscribers
+        :return:
+        """
         self.logger.debug("publishing payload:{}".format(payload))
+        start = self.loop.time()
+        try:
+            await self.mqtt_client.publish(
+                topic,
+                self.encoding.dumps(payload),
+                qos=QOS_1,
+                retain=retain
+            )
+        except Exception:
+            self.metrics.inc('mqtt_publish_errors_total')
+            raise
+        self.metrics.observe('mqtt_publish_seconds', self.loop.time() - start)
+
+    def update_gauges(self):
+        """Update the metrics gauges of queue depth and connections from their current state
+
+        """
+        for device_id, stats in self.queue_stats.items():
+            for priority, depth in stats['depth_by_priority'].items():
+                self.metrics.set('command_queue_depth', depth, device=device_id, priority=priority)
+        for timer in self.devices.values():
+            self.metrics.set('device_connected', int(bool(timer.connection and timer.connection.connected)),
+                             device=timer.device_id)
+
+    async def publish_metrics(self):
+        """Publish all metrics as JSON on the service metrics topic
+
+        :return:
+        """
+        self.update_gauges()
         await self.mqtt_client.publish(
-            topic,
-            json.dumps(payload).encode("utf-8"),
+            '{}/{}'.format(self.TOPIC_PREFIX, TimerMqttService.METRICS_TOPIC),
+            json.dumps(self.metrics.as_dict()).encode("utf-8"),
             qos=QOS_1
         )
 
+    async def publish_meta(self, timer):
+        """Announce the payload encoding of a device on its meta topic, always as JSON
+
+        :param timer: TimerDevice
+        :return:
+        """
+        meta = {
+            'encoding': self.encoding.name
+        }
+        if hasattr(self.encoding, 'layout'):
+            meta['attributes'] = self.encoding.layout
+        await self.mqtt_client.publish(
+            self.topic(timer, TimerMqttService.META_TOPIC),
+            json.dumps(meta).encode("utf-8"),
+            qos=QOS_1,
+            retain=True
+        )
+
+    def _on_notify(self, timer, item, value):
+        """Handle a notification from the device, called from the BLE thread
+
+        :param timer: TimerDevice
+        :param item: name of item
+        :param value: converted value
+        :return:
+        """
+        self.logger.debug("notify {} {}: {}".format(timer, item, value))
+        self.loop.call_soon_threadsafe(
+            asyncio.ensure_future, self._publish_notify(timer, {item: value})
+        )
+
+    async def _publish_notify(self, timer, values):
+        try:
+            await self.publish_values(timer, values)
+        except Exception as e:
+            self.logger.error('publish error: {}'.format(e))
+
     async def _producer(self):
         # connect MQTT client
         await self.mqtt_client.connect(self.mqtt_url)
         await self.mqtt_client.subscribe([
-            (TimerMqttService.COMMAND_TOPIC, QOS_1),
+            ('{}/+/{}'.format(self.TOPIC_PREFIX, TimerMqttService.COMMAND_TOPIC), QOS_1),
         ])
+        for timer in self.devices.values():
+            await self.publish_meta(timer)
         while self.running:
             try:
                 # wait for incoming MQTT messages
                 msg = await self.mqtt_client.deliver_message()
+                topic = msg.publish_packet.variable_header.topic_name
                 self.logger.debug('topic: {} payload: {}'.format(
-                    msg.publish_packet.variable_header.topic_name,
+                    topic,
                     msg.publish_packet.payload.data
                 ))
-                if msg.publish_packet.variable_header.topic_name == TimerMqttService.COMMAND_TOPIC:
-                    # process if on the command topic
+                # route to the device queue if on a device command topic
+                timer = self._command_topic_device(topic)
+                if timer:
                     await asyncio.sleep(0)
                     data = json.loads(msg.publish_packet.payload.data.decode('utf-8'))
                     self.logger.debug("mqtt packet: {}".format(data))
-                    await self.command_queue.put(data)
-            except:
-                pass
+                    if isinstance(data, list) or 'id' in data:
+                        # lists of commands and commands with a correlation id are acked
+                        data = {'cmd': 'batch', 'commands': data if isinstance(data, list) else [data]}
+                        if not all(isinstance(command, dict) for command in data['commands']):
+                            self.logger.error("commands in a batch must be objects: {}".format(data))
+                            continue
+                    # a full queue rejects the command rather than holding up commands for other devices
+                    try:
+                        timer.command_queue.put_nowait(data, self.command_priority(data))
+                    except asyncio.QueueFull:
+                        await self._reject(timer, data, 'queue full')
+            except Exception as e:
+                self.logger.error("command error: {}".format(e))
+
+    async def _reject(self, timer, command, error):
+        """Drop a command that could not be queued, acking each command of a batch with the error
+
+        :param timer: TimerDevice
+        :param command: command dict
+        :param error: error message
+        :return:
+        """
+        self.logger.error('{} command rejected, {}: {}'.format(timer, error, command))
+        timer.metrics.inc('commands_rejected_total', cmd=command.get('cmd'))
+        if command.get('cmd') == 'batch':
+            await self.mqtt_client.publish(
+                self.topic(timer, TimerMqttService.RESPONSE_TOPIC),
+                json.dumps({'results': [self._ack(c, error) for c in command['commands']]}).encode("utf-8"),
+                qos=QOS_1
+            )
+
+    def _command_topic_device(self, topic):
+        """Find the device for a command topic
+
+        :param topic: full topic name
+        :return: TimerDevice or None
+        """
+        parts = topic.split('/')
+        if len(parts) != 3 or parts[0] != self.TOPIC_PREFIX or parts[2] != TimerMqttService.COMMAND_TOPIC:
+            return None
+        return self.devices.get(parts[1])
 
-    async def _consumer(self):
-        self.logger.debug("start consumer")
+    async def _consumer(self, timer):
+        self.logger.debug("start consumer for {}".format(timer))
         while self.running:
+            # commands stay queued while the device is unreachable
+            await timer.link_up.wait()
             self.logger.debug("waiting for queue item")
             # wait for incoming queue items
-            item = await self.command_queue.get()
+            item = await timer.command_queue.get()
             self.logger.debug("got queue item: {}".format(item))
 
-            await self.process_command(item)
+            await self.process_command(timer, item)
 
-            self.command_queue.task_done()
+    async def _poll(self):
+        """Start the loop queueing reads of the attributes due for polling on each device
 
-    async def _battery_notify(self):
-        """Start the loop to notify MQTT of Battery level
+        The first poll of each device reads all attributes, after that each attribute is
+        polled as often as its PollPolicy asks for.
 
         :return:
         """
         # wait a few seconds before starting
         await asyncio.sleep(5)
-        self.logger.debug("start battery notify")
+        self.logger.debug("start polling")
         while self.running:
-            await asyncio.sleep(0)
-            data = {'cmd': 'get', 'item': 'battery'}
-            await self.command_queue.put(data)
+            for timer in self.devices.values():
+                if not timer.poll_scheduler.last_seen:
+                    item = 'all'
+                    timer.poll_scheduler.seen(TimerService.ATTRIBUTES)
+                else:
+                    notifying = bool(timer.timer_service and timer.timer_service.notifying)
+                    item = timer.poll_scheduler.due(timer.published, notifying)
+                    if not item:
+                        continue
+                await timer.command_queue.put({'cmd': 'get', 'item': item, 'poll': True}, PRIORITY_POLL)
+
+            for timer in self.devices.values():
+                if timer.clock_synced_at is None or (
+                        self.clock_sync_interval is not None
+                        and self.loop.time() - timer.clock_synced_at >= self.clock_sync_interval):
+                    timer.clock_synced_at = self.loop.time()
+                    await timer.command_queue.put({'cmd': 'sync_clock', 'poll': True}, PRIORITY_POLL)
 
-            # wait for 10 minutes
-            await asyncio.sleep(60 * self.battery_notify_interval)
+            await asyncio.sleep(self.poll_check_interval)
 
-    async def _all_notify(self):
-        """Start the loop to notify MQTT of All details
+    async def _idle_disconnect(self):
+        """Start the loop to disconnect devices that have not been used for a while
 
         :return:
         """
-        # wait a few seconds before starting
-        await asyncio.sleep(5)
-        self.logger.debug("start all notify")
+        if self.idle_disconnect is None:
+            return
+        self.logger.debug("start idle disconnect")
         while self.running:
-            await asyncio.sleep(0)
-            data = {'cmd': 'get', 'item': 'all'}
-            await self.command_queue.put(data)
+            await asyncio.sleep(min(5, self.idle_disconnect / 2))
+            await self.loop.run_in_executor(self.ble_executor, self.connections.disconnect_idle)
 
-            # wait for 10 minutes
-            await asyncio.sleep(60 * self.battery_notify_interval)
+    async def _metrics_notify(self):
+        """Start the loop to publish metrics and serve them to Prometheus
+
+        :return:
+        """
+        if self.prometheus_port:
+            await self.metrics.serve_prometheus(self.prometheus_port, before_scrape=self.update_gauges)
+        if self.metrics_interval is None:
+            return
+        self.logger.debug("start metrics notify")
+        while self.running:
+            await asyncio.sleep(self.metrics_interval)
+            try:
+                await self.publish_metrics()
+            except Exception as e:
+                self.logger.error('metrics error: {}'.format(e))
 
     def _disconnect_timer_service(self):
-        if self.device:
-            self.device.disconnect()
+        self.connections.disconnect_all()
+
+    async def serve(self):
+        """Run the MQTT client, command consumers and notify loops on the service loop
+
+        Call setup_ble() first, useful to run the service inside an existing event loop.
+
+        :return:
+        """
+        await asyncio.gather(
+            self._producer(),
+            self._poll(),
+            self._idle_disconnect(),
+            self._metrics_notify(),
+            *[self._consumer(timer) for timer in self.devices.values()],
+            return_exceptions=True
+        )
 
     def _run_mqtt(self):
         """Start MQTT service and other notify loops
 
         :return:
         """
-
-        cors = asyncio.wait([
-            self._consumer(),
-            self._producer(),
-            self._all_notify(),
-            self._battery_notify()
-        ])
-        self.loop.run_until_complete(cors)
+        self.loop.run_until_complete(self.serve())
@@ -0,0 +1,109 @@
+import time
+
+# Values of the status attribute
+STATUS_OFF = 1
+STATUS_AUTO = 2
+STATUS_MANUAL = 10
+
+
+def watering_manually(values):
+    """True while the timer runs a manual watering, its time left then counts down
+
+    :param values: dict of last known attribute values
+    :return: bool
+    """
+    return values.get('status') == STATUS_MANUAL
+
+
+class PollPolicy:
+    """How often one attribute is polled, from the last known values of the device
+
+    """
+
+    def __init__(self, interval=None, notified_interval=None, active=None, active_interval=None):
+        """
+
+        :param interval: seconds between polls, None to never poll
+        :param notified_interval: seconds between polls while the device notifies changes, None to not poll
+        :param active: optional function of the last known values, True while the attribute changes quickly
+        :param active_interval: seconds between polls while active
+        """
+        self.interval = interval
+        self.notified_interval = notified_interval
+        self.active = active
+        self.active_interval = active_interval
+
+    def poll_interval(self, values, notifying):
+        """Return seconds between polls, or None to not poll
+
+        :param values: dict of last known attribute values
+        :param notifying: True if the device notifies changes
+        :return: seconds or None
+        """
+        if self.active is not None and self.active(values):
+            return self.active_interval
+        return self.notified_interval if notifying else self.interval
+
+
+# Attributes missing from the policies are never polled, e.g. those only changed by writes and the
+# device clock, which TimerService answers from its clock model
+DEFAULT_POLL_POLICIES = {
+    # drains slowly, notified while connected
+    'battery': PollPolicy(interval=3600),
+    # follows the watering, which starts by itself on auto cycles, and is not notified
+    'on': PollPolicy(interval=600, notified_interval=600, active=watering_manually, active_interval=30),
+    'status': PollPolicy(interval=600),
+    'manual_time_left': PollPolicy(interval=600, active=watering_manually, active_interval=30),
+    'rain_delay_time': PollPolicy(interval=3600)
+}
+
+
+class PollScheduler:
+    """Decide which attributes of one device are due to be polled
+
+    An attribute is due once its policy interval has passed since its value was last
+    seen, from a poll, a command or a notification. Intervals are worked out from the
+    current values, so a change of state e.g. a manual watering starting takes effect
+    on the next check.
+
+    """
+
+    def __init__(self, policies=None, clock=time.monotonic):
+        """
+
+        :param policies: dict of attribute name to PollPolicy, defaults to DEFAULT_POLL_POLICIES
+        :param clock: function returning the current time in seconds
+        """
+        self.policies = DEFAULT_POLL_POLICIES if policies is None else policies
+        self.clock = clock
+        self.last_seen = {}
+
+    def seen(self, items):
+        """Record that attribute values were just read or notified
+
+        :param items: attribute names
+        :return:
+        """
+        now = self.clock()
+        for item in items:
+            self.last_seen[item] = now
+
+    def due(self, values, notifying):
+        """Return the attributes due to be polled, marking them as seen
+
+        :param values: dict of last known attribute values
+        :param notifying: True if the device notifies changes
+        :return: list of attribute names
+        """
+        now = self.clock()
+        items = []
+        for item, policy in self.policies.items():
+            interval = policy.poll_interval(values, notifying)
+            if interval is None:
+                continue
+            last_seen = self.last_seen.get(item)
+            if last_seen is None or now - last_seen >= interval:
+                items.append(item)
+        # marked now so a poll that fails is retried after a full interval rather than straight away
+        self.seen(items)
+        return items
@@ -0,0 +1,397 @@
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from .discovery import DEVICE_INFO_SERVICE_UUID, FIRMWARE_REVISION_CHAR_UUID
+from .timer import TimerService, BATTERY_SERVICE_UUID, TIMER_SERVICE_UUID
+
+# Values a new simulated timer starts with
+DEFAULT_VALUES = {
+    'battery': 87,
+    'on': 0,
+    'status': 2,
+    'time': [0, 0, 0],
+    'cycle1_start': [5, 30],
+    'cycle2_start': [255, 0],
+    'cycle_duration': 29,
+    'cycle_frequency': 4,
+    'manual_time_left': [0, 5],
+    'rain_delay_time': 0,
+}
+
+STATUS_AUTO = 2
+STATUS_MANUAL = 10
+
+SERVICE_UUIDS = {
+    'timer': TIMER_SERVICE_UUID,
+    'battery': BATTERY_SERVICE_UUID
+}
+
+
+class SimulatedError(RuntimeError):
+    pass
+
+
+class SimulatedCharacteristic:
+    """GATT characteristic of a simulated timer holding the raw bytes of one attribute
+
+    """
+
+    def __init__(self, device, item):
+        self.device = device
+        self.item = item
+        self.uuid = TimerService.ATTRIBUTES[item]['uuid']
+        self.value = bytearray()
+        self._on_change = None
+
+    def read_value(self, timeout_sec=None):
+        self.device.operation('read')
+        return self.device.read(self.item)
+
+    def write_value(self, value, write_type=None):
+        self.device.operation('write')
+        self.device.write(self.item, bytearray(value))
+
+    def start_notify(self, on_change):
+        self.device.operation('notify')
+        self._on_change = on_change
+
+    def stop_notify(self):
+        self._on_change = None
+
+    def notify(self):
+        """Send the current value to the notify subscriber, if any
+
+        """
+        on_change = self._on_change
+        if on_change is not None:
+            self.device.stats['notifications'] += 1
+            if self.device.bluez_values:
+                # bluez passes notifications as a str of one character per byte
+                on_change(''.join(map(chr, self.value)))
+            else:
+                on_change(bytearray(self.value))
+
+
+class SimulatedStaticCharacteristic:
+    """Read only GATT characteristic with a fixed value, e.g. the firmware revision
+
+    """
+
+    def __init__(self, device, uuid, value):
+        self.device = device
+        self.uuid = uuid
+        self.value = bytearray(value)
+
+    def read_value(self, timeout_sec=None):
+        self.device.operation('read')
+        return bytearray(self.value)
+
+
+class SimulatedService:
+
+    def __init__(self, uuid, characteristics):
+        self.uuid = uuid
+        self.characteristics = characteristics
+
+    def list_characteristics(self):
+        return list(self.characteristics.values())
+
+    def find_characteristic(self, uuid):
+        return self.characteristics.get(uuid)
+
+
+class SimulatedDevice:
+    """Aqua Systems timer simulated in process, with the services and byte formats of TimerService
+
+    Every GATT operation waits for the configured latency plus up to jitter seconds, and
+    fails with SimulatedError at the configured failure rate. Latency and failure rates are
+    dicts per operation: 'connect', 'discover', 'read', 'write' and 'notify'. Like with bluez,
+    services are only found 'resolve' seconds after connecting, discovery waits for them.
+
+    The device clock runs clock_drift faster than real time, e.g. 0.001 gains 86s a day.
+
+    With bluez_values set, reads return lists of ints the way the Adafruit bluez provider
+    returns a dbus.Array, and notifications are sent as str, instead of bytearrays.
+
+    """
+
+    def __init__(self, name, address=None, values=None, latency=None, jitter=0.0, failure_rate=None,
+                 clock_drift=0.0, seed=None, clock=time.monotonic, firmware='1.0', bluez_values=False):
+        """
+
+        :param name: advertised device name
+        :param address: device address, random if not given
+        :param values: dict of initial decoded values per attribute, see DEFAULT_VALUES
+        :param latency: dict of seconds per operation
+        :param jitter: maximum random seconds added to each operation
+        :param failure_rate: dict of failure probability per operation
+        :param clock_drift: fraction the device clock runs fast, negative for slow
+        :param seed: random seed for jitter and failures
+        :param clock: function returning the current time in seconds
+        :param firmware: firmware revision reported by the Device Information service
+        :param bluez_values: return raw values in the types of the bluez provider
+        """
+        self.name = name
+        self.bluez_values = bluez_values
+        self.id = address or ':'.join('{:02X}'.format(b) for b in uuid.uuid4().bytes[:6])
+        self.address = self.id
+        self.advertised = [TIMER_SERVICE_UUID]
+        self.latency = latency or {}
+        self.jitter = jitter
+        self.failure_rate = failure_rate or {}
+        self.clock_drift = clock_drift
+        self.clock = clock
+        self.in_range = True
+        self.is_connected = False
+        self.connected_at = None
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+        services = {}
+        for item, attr in TimerService.ATTRIBUTES.items():
+            service_uuid = SERVICE_UUIDS[attr['service']]
+            characteristic = SimulatedCharacteristic(self, item)
+            services.setdefault(service_uuid, {})[characteristic.uuid] = characteristic
+        self.services = {service_uuid: SimulatedService(service_uuid, characteristics)
+                         for service_uuid, characteristics in services.items()}
+        self.characteristics = {
+            characteristic.item: characteristic
+            for service in self.services.values() for characteristic in service.list_characteristics()
+        }
+        self.services[DEVICE_INFO_SERVICE_UUID] = SimulatedService(DEVICE_INFO_SERVICE_UUID, {
+            FIRMWARE_REVISION_CHAR_UUID: SimulatedStaticCharacteristic(
+                self, FIRMWARE_REVISION_CHAR_UUID, firmware.encode('utf-8'))
+        })
+
+        initial = dict(DEFAULT_VALUES)
+        initial.update(values or {})
+        for item, value in initial.items():
+            if item != 'time':
+                self.characteristics[item].value = TimerService.CODECS[item].encode(value)
+        # device clock as seconds since midnight at the time of creation
+        hours, minutes, seconds = initial['time']
+        self._clock_base = self.clock()
+        self._clock_offset = hours * 3600 + minutes * 60 + seconds
+
+    def __repr__(self):
+        return '<SimulatedDevice "{}" {}>'.format(self.name, self.id)
+
+    def operation(self, kind):
+        """Simulate the latency and failures of a GATT operation, blocking
+
+        :param kind: operation name e.g. 'read'
+        :return:
+        """
+        if kind != 'connect' and not self.is_connected:
+            raise SimulatedError('{} not connected'.format(self.name))
+        self.stats[kind] += 1
+        delay = self.latency.get(kind, 0.0)
+        if self.jitter:
+            delay += self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self._random.random() < self.failure_rate.get(kind, 0.0):
+            self.stats['{}_failures'.format(kind)] += 1
+            raise SimulatedError('simulated {} failure'.format(kind))
+
+    def connect(self, timeout_sec=None):
+        if not self.in_range:
+            time.sleep(min(timeout_sec or 0, self.latency.get('connect', 0.0)))
+            raise SimulatedError('{} out of range'.format(self.name))
+        self.operation('connect')
+        self.is_connected = True
+        self.connected_at = self.clock()
+
+    def disconnect(self, timeout_sec=None):
+        self.stats['disconnect'] += 1
+        self.drop()
+
+    def drop(self):
+        """Lose the connection, e.g. when the device goes out of range
+
+        """
+        self.is_connected = False
+        for characteristic in self.characteristics.values():
+            characteristic.stop_notify()
+
+    @property
+    def services_resolved(self):
+        return self.is_connected and self.clock() - self.connected_at >= self.latency.get('resolve', 0.0)
+
+    def discover(self, service_uuids, char_uuids, timeout_sec=None):
+        if self.is_connected:
+            time.sleep(max(0.0, self.connected_at + self.latency.get('resolve', 0.0) - self.clock()))
+        self.operation('discover')
+
+    def list_services(self):
+        return list(self.services.values())
+
+    def find_service(self, uuid):
+        if not self.services_resolved:
+            return None
+        return self.services.get(uuid)
+
+    def get(self, item):
+        """Return the decoded value of an attribute as stored on the device
+
+        :param item: name of item
+        :return:
+        """
+        if item == 'time':
+            return self.device_time()
+        return TimerService.CODECS[item].decode(self.characteristics[item].value)
+
+    def set(self, item, value):
+        """Change an attribute on the device side, e.g. the battery draining, notifying any subscriber
+
+        :param item: name of item
+        :param value: decoded value
+        :return:
+        """
+        self.write(item, TimerService.CODECS[item].encode(value))
+
+    def device_time(self):
+        """Return the device clock as [hours, minutes, seconds]
+
+        """
+        elapsed = (self.clock() - self._clock_base) * (1 + self.clock_drift)
+        seconds = int(self._clock_offset + elapsed) % 86400
+        return [seconds // 3600, seconds // 60 % 60, seconds % 60]
+
+    def write(self, item, raw):
+        """Apply a written value the way the timer does
+
+        :param item: name of item
+        :param raw: raw value
+        :return:
+        """
+        value = TimerService.CODECS[item].decode(raw)
+        if item == 'time':
+            hours, minutes, seconds = value
+            with self._lock:
+                self._clock_base = self.clock()
+                self._clock_offset = hours * 3600 + minutes * 60 + seconds
+            return
+
+        self._update(item, raw)
+        if item == 'manual_time_left':
+            # starting a manual watering opens the valve until it ends
+            manual = value[0] == 1
+            self.set('status', STATUS_MANUAL if manual else STATUS_AUTO)
+            self.set('on', 1 if manual else 0)
+
+    def _update(self, item, raw):
+        characteristic = self.characteristics[item]
+        with self._lock:
+            changed = characteristic.value != raw
+            characteristic.value = bytearray(raw)
+        if changed and TimerService.ATTRIBUTES[item]['can_notify']:
+            characteristic.notify()
+
+    def read(self, item):
+        """Return the raw value of an attribute
+
+        :param item: name of item
+        :return: raw value
+        """
+        if item == 'time':
+            raw = TimerService.CODECS['time'].encode(self.device_time())
+        else:
+            raw = bytearray(self.characteristics[item].value)
+        if self.bluez_values:
+            return list(raw)
+        return raw
+
+
+class SimulatedAdapter:
+
+    def __init__(self, name='simulated'):
+        self.name = name
+        self.is_powered = False
+        self.is_scanning = False
+        self.scan_started = None
+        self.scans = 0
+
+    def power_on(self):
+        self.is_powered = True
+
+    def power_off(self):
+        self.is_powered = False
+
+    def start_scan(self, timeout_sec=None):
+        self.is_scanning = True
+        self.scan_started = time.monotonic()
+        self.scans += 1
+
+    def stop_scan(self, timeout_sec=None):
+        self.is_scanning = False
+
+
+class SimulatedProvider:
+    """BLE provider serving simulated timers, a stand in for Adafruit_BluefruitLE.get_provider()
+
+    Like bluez, devices are only known once a scan has seen them, and stay known until
+    clear_cached_data() is called.
+
+    """
+
+    def __init__(self, devices=(), scan_latency=0.0):
+        """
+
+        :param devices: list of SimulatedDevice
+        :param scan_latency: seconds a scan takes to see a device
+        """
+        self.devices = list(devices)
+        self.scan_latency = scan_latency
+        self.adapter = SimulatedAdapter()
+        self.known = []
+
+    def initialize(self):
+        pass
+
+    def run_mainloop_with(self, target):
+        target()
+
+    def clear_cached_data(self):
+        self.known = []
+
+    def get_default_adapter(self):
+        return self.adapter
+
+    def list_adapters(self):
+        return [self.adapter]
+
+    def list_devices(self):
+        self._update_known()
+        return list(self.known)
+
+    def find_devices(self, service_uuids=[], name=None):
+        return [
+            device for device in self.list_devices()
+            if (name is None or device.name == name)
+            and all(service_uuid in device.advertised for service_uuid in service_uuids)
+        ]
+
+    def find_device(self, service_uuids=[], name=None, timeout_sec=60):
+        deadline = time.monotonic() + timeout_sec
+        while True:
+            devices = self.find_devices(service_uuids, name)
+            if devices or time.monotonic() >= deadline:
+                return devices[0] if devices else None
+            time.sleep(0.01)
+
+    def disconnect_devices(self, service_uuids=[]):
+        for device in self.find_devices(service_uuids):
+            if device.is_connected:
+                device.disconnect()
+
+    def _update_known(self):
+        adapter = self.adapter
+        if adapter.is_scanning and time.monotonic() - adapter.scan_started >= self.scan_latency:
+            for device in self.devices:
+                if device.in_range and device not in self.known:
+                    self.known.append(device)
@@ -1,8 +1,15 @@
 import logging
+import time
 import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from Adafruit_BluefruitLE.services.servicebase import ServiceBase
 
+from .cache import AttributeCache
+from .clock import ClockModel
+from .codec import AttributeCodec, FrameError
+
 # Define service and characteristic UUIDs.
 TIMER_SERVICE_UUID = uuid.UUID('0000FCC0-0000-1000-8000-00805F9B34FB')
 BATTERY_SERVICE_UUID = uuid.UUID('0000180f-0000-1000-8000-00805f9b34fb')
@@ -25,6 +32,82 @@ MANUAL_TIME_CHAR_UUID = uuid.UUID('0000fcd9-0000-1000-8000-00805f9b34fb')
 # TIMER1_CHAR_UUID = uuid.UUID('0000fcc1-0000-1000-8000-00805f9b34fb')
 
 
+# D-Bus errors bluez raises when a characteristic object no longer exists, e.g. after a reconnect
+STALE_DBUS_ERRORS = ('org.freedesktop.DBus.Error.UnknownObject', 'org.freedesktop.DBus.Error.UnknownMethod')
+
+
+class StaleHandleError(RuntimeError):
+    """A characteristic is not indexed, or its handle is from an earlier connection"""
+    pass
+
+
+def _is_stale(e):
+    """True if a GATT operation failed because the characteristic handle is stale"""
+    if isinstance(e, StaleHandleError):
+        return True
+    get_dbus_name = getattr(e, 'get_dbus_name', None)
+    return get_dbus_name is not None and get_dbus_name() in STALE_DBUS_ERRORS
+
+
+def _on_value(val):
+    """Convert on value to True/False"""
+    return val == 1
+
+
+def _manual_time_left_value(val):
+    """Return manual duration if in manual mode, otherwise 0"""
+    # check if manual mode is turned on
+    if val[0] == 1:
+        return val[1]
+    return 0
+
+
+class Snapshot(dict):
+    """Attribute values from a bulk read
+
+    Attributes that failed to read are left out and listed in errors with the reason.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = {}
+
+
+class ProgramResult:
+    """Outcome of writing a watering program
+
+    """
+
+    def __init__(self):
+        # attributes written and confirmed by the read back
+        self.written = []
+        # attributes already at the requested value, not written
+        self.unchanged = []
+        # dict of attribute name to reason for attributes that could not be written or confirmed
+        self.failed = {}
+        # attributes restored to their previous value after a failure
+        self.rolled_back = []
+        # values read back from the device
+        self.values = {}
+
+    @property
+    def applied(self):
+        """True if the whole program is on the device
+
+        """
+        return not self.failed
+
+    def as_dict(self):
+        return {
+            'applied': self.applied,
+            'written': self.written,
+            'unchanged': self.unchanged,
+            'failed': self.failed,
+            'rolled_back': self.rolled_back
+        }
+
+
 class TimerService(ServiceBase):
     """Bluetooth LE Aqua Systems water timer service object."""
 
@@ -156,22 +239,66 @@ class TimerService(ServiceBase):
         }
     }
 
+    # Encoder/decoder for each attribute, compiled once from the format lists
+    CODECS = {name: AttributeCodec(attr['format']) for name, attr in ATTRIBUTES.items()}
+
+    # Conversions applied to decoded values of some attributes
+    CONVERTERS = {
+        'on': _on_value,
+        'manual_time_left': _manual_time_left_value
+    }
+
+    # Attributes the device pushes changes for, and those that have to be polled
+    NOTIFY_ATTRIBUTES = [name for name, attr in ATTRIBUTES.items() if attr['can_notify']]
+    POLL_ATTRIBUTES = [name for name, attr in ATTRIBUTES.items() if not attr['can_notify']]
+
+    # Attributes that may change on the device by themselves, to read again after missing notifications
+    VOLATILE_ATTRIBUTES = NOTIFY_ATTRIBUTES + ['on']
+
+    # Attributes that may change on the device when another attribute is written
+    DEPENDENT_ATTRIBUTES = {
+        'manual_time_left': ['status', 'on'],
+        'rain_delay_time': ['status'],
+    }
+
+    # Attributes making up a watering program, written together by program()
+    PROGRAM_ATTRIBUTES = ['cycle1_start', 'cycle2_start', 'cycle_duration', 'cycle_frequency']
+
+    # Default cache TTL in seconds per attribute, attributes not listed are not cached
+    CACHE_TTL = {}
+
+    read_timeout = 5  # seconds per attribute in bulk reads
+    max_reads_in_flight = 4
+
     # Configure expected services and characteristics for the  service.
     ADVERTISED = [TIMER_SERVICE_UUID]
     SERVICES = [TIMER_SERVICE_UUID, BATTERY_SERVICE_UUID]
     CHARACTERISTICS = [CYCLE1_DUR_CHAR_UUID, TIME_CHAR_UUID]
 
-    def __init__(self, device):
-        """Initialize Timer from provided device."""
+    def __init__(self, device, cache_ttl=None, executor=None, metrics=None, discovered=True):
+        """Initialize Timer from provided device.
+
+        :param device: connected device
+        :param cache_ttl: optional dict of cache TTL in seconds per attribute
+        :param executor: optional executor for bulk reads, shared between timers
+        :param metrics: optional Metrics to record GATT operation times and errors in
+        :param discovered: False if service discovery was skipped, it then runs when a GATT operation fails
+        """
         self.logger = logging.getLogger(__name__)
         self.device = device
+        self.metrics = metrics
+        self.discovered = discovered
+        self.cache = AttributeCache(self.CACHE_TTL if cache_ttl is None else cache_ttl)
+        # the device clock is estimated from occasional reads instead of read each time
+        self.clock_model = ClockModel()
+        self.notifying = False
+        self._executor = executor
+        self._own_executor = executor is None
+        # timed out bulk reads still holding a worker
+        self._abandoned = set()
         # Find the Timer service and characteristics associated with the device.
-        self._timer = self.device.find_service(TIMER_SERVICE_UUID)
-        self._battery = self.device.find_service(BATTERY_SERVICE_UUID)
-        if self._timer is None:
-            raise RuntimeError('Failed to find expected Timer service!')
-        if self._battery is None:
-            raise RuntimeError('Failed to find expected Battery service!')
+        self._characteristics = {}
+        self.rebind()
 
     def __getattr__(self, item):
         # lookup attribute in array
@@ -182,28 +309,7 @@ class TimerService(ServiceBase):
             else:
                 return None
 
-        # get attribute details from array
-        attr = self.ATTRIBUTES[item]
-
-        # init service and characteristic
-        characteristic = self._get_characteristic(attr['service'], attr['uuid'])
-        # read the value
-        val = characteristic.read_value()
-
-        return self._parse_value(item, val)
-
-        results = []
-        idx = 0
-        for el in attr['format']:
-            # save result if it's not a placeholder char
-            if type(el) == str:
-                results.append(val[idx])
-            idx += 1
-
-        # if we only have one result return that, otherwise return list
-        if len(results) == 1:
-            return results[0]
-        return results
+        return self.read(item)
 
     def __setattr__(self, item, value):
         # lookup attribute in array
@@ -219,7 +325,291 @@ class TimerService(ServiceBase):
         if not attr['can_set']:
             return False
 
-        return self._write_attr(attr, value)
+        return self._write_attr(item, value)
+
+    def read(self, item, fresh=False):
+        """Read the value of an attribute, from the cache if it has not expired
+
+        :param item: name of item
+        :param fresh: bypass the cache and read from the device
+        :return:
+        """
+        val = self._read_attr(item, fresh)
+        if item in self.CONVERTERS:
+            return self.CONVERTERS[item](val)
+        return val
+
+    def read_many(self, items=None, timeout=None, fresh=False):
+        """Read several attributes with reads kept in flight concurrently
+
+        Each read has its own timeout, a read that fails or times out is reported in
+        the errors of the returned snapshot instead of failing the whole read.
+
+        :param items: list of item names, defaults to all attributes
+        :param timeout: seconds allowed per attribute, defaults to read_timeout
+        :param fresh: bypass the cache and read from the device
+        :return: Snapshot
+        """
+        items = list(self.ATTRIBUTES if items is None else items)
+        timeout = self.read_timeout if timeout is None else timeout
+
+        values = {}
+        errors = {}
+        queue = deque()
+        for item in items:
+            if not fresh:
+                found, val = self._known_value(item)
+                if found:
+                    values[item] = val
+                    continue
+            queue.append(item)
+
+        executor = self._get_executor()
+        running = {}
+        while queue or running:
+            # free workers that finished their timed out reads
+            self._abandoned = {f for f in self._abandoned if not f.done()}
+            while queue and len(running) + len(self._abandoned) < self.max_reads_in_flight:
+                item = queue.popleft()
+                future = executor.submit(self._read_attr, item, True)
+                running[future] = (item, time.monotonic() + timeout)
+
+            if not running:
+                # every worker is stuck on a read that already timed out
+                for item in queue:
+                    errors[item] = 'timeout'
+                break
+
+            next_deadline = min(deadline for item, deadline in running.values())
+            wait(running, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+
+            now = time.monotonic()
+            for future, (item, deadline) in list(running.items()):
+                if future.done():
+                    del running[future]
+                    try:
+                        values[item] = future.result()
+                    except Exception as e:
+                        errors[item] = str(e) or type(e).__name__
+                elif deadline <= now:
+                    del running[future]
+                    self._abandoned.add(future)
+                    errors[item] = 'timeout'
+                    if self.metrics:
+                        self.metrics.inc('ble_errors_total', op='timeout', attribute=item)
+
+        snapshot = Snapshot()
+        for item in items:
+            if item in values:
+                val = values[item]
+                snapshot[item] = self.CONVERTERS[item](val) if item in self.CONVERTERS else val
+        snapshot.errors = errors
+        if errors:
+            self.logger.debug("bulk read errors: {}".format(errors))
+        return snapshot
+
+    def close(self):
+        """Stop the bulk read workers
+
+        """
+        if self._executor and self._own_executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_reads_in_flight)
+        return self._executor
+
+    def _read_attr(self, item, fresh=False):
+        """Read the decoded value of an attribute and update the cache
+
+        :param item: name of item
+        :param fresh: bypass the cache and read from the device
+        :return:
+        """
+        if not fresh:
+            found, val = self._known_value(item)
+            if found:
+                return val
+
+        val = self._parse_value(item, self._read_raw(item))
+        self.cache.set(item, val)
+        if item == 'time':
+            self.clock_model.add_sample(val)
+        return val
+
+    @classmethod
+    def encode_program(cls, schedule):
+        """Encode the values of a watering program, without a device
+
+        :param schedule: dict of attribute name from PROGRAM_ATTRIBUTES to value
+        :return: tuple of OrderedDict of attribute name to bytes, and dict of attribute name to reason for invalid values
+        """
+        targets = OrderedDict()
+        failed = {}
+        for item in schedule:
+            if item not in cls.PROGRAM_ATTRIBUTES:
+                failed[item] = '{} is not part of a program'.format(item)
+        for item in cls.PROGRAM_ATTRIBUTES:
+            if item in schedule:
+                try:
+                    targets[item] = cls.CODECS[item].encode(schedule[item])
+                except (ValueError, TypeError) as e:
+                    failed[item] = str(e) or type(e).__name__
+        return targets, failed
+
+    def program(self, schedule, known=None, rollback=True):
+        """Write a watering program, only the attributes that differ from their known values
+
+        The written attributes are confirmed with a single read back. If any of them fails,
+        the attributes already changed are restored to their previous values when rollback is set.
+        Nothing is written if any value is invalid or a current value can not be read,
+        the result then lists the invalid values or read errors as failed.
+
+        :param schedule: dict of attribute name from PROGRAM_ATTRIBUTES to value
+        :param known: optional dict of last known values, other attributes are read first
+        :param rollback: restore the previous values if the program is not fully applied
+        :return: ProgramResult
+        """
+        result = ProgramResult()
+        # encode everything first so a bad value fails before anything is written
+        targets, result.failed = self.encode_program(schedule)
+        if result.failed:
+            return result
+
+        known = dict(known or {})
+        missing = [item for item in targets if item not in known]
+        if missing:
+            snapshot = self.read_many(missing)
+            if snapshot.errors:
+                # nothing is written without the previous values to restore
+                result.failed.update(snapshot.errors)
+                for item in targets:
+                    result.failed.setdefault(item, 'not written')
+                return result
+            known.update(snapshot)
+
+        previous = OrderedDict()
+        for item, byte_val in targets.items():
+            if self._encoded_equal(item, known[item], byte_val):
+                result.unchanged.append(item)
+            else:
+                previous[item] = known[item]
+        if not previous:
+            return result
+
+        attempted = []
+        for item in previous:
+            attempted.append(item)
+            try:
+                self._write_attr(item, schedule[item])
+            except Exception as e:
+                result.failed[item] = str(e) or type(e).__name__
+                break
+
+        # one read back of everything attempted, a failed write may still have reached the device
+        snapshot = self.read_many(attempted, fresh=True)
+        result.values = dict(snapshot)
+        for item in attempted:
+            if item in snapshot.errors:
+                result.failed.setdefault(item, snapshot.errors[item])
+            elif not self._encoded_equal(item, snapshot[item], targets[item]):
+                result.failed.setdefault(item, 'read back {}'.format(snapshot[item]))
+            else:
+                result.written.append(item)
+        for item in previous:
+            if item not in attempted:
+                result.failed[item] = 'not written'
+
+        if result.failed and rollback:
+            for item in attempted:
+                if item in snapshot and self._encoded_equal(
+                        item, snapshot[item], self.CODECS[item].encode(previous[item])):
+                    # never changed
+                    continue
+                try:
+                    self._write_attr(item, previous[item])
+                    result.rolled_back.append(item)
+                    result.values[item] = previous[item]
+                except Exception as e:
+                    self.logger.error("rollback of {} failed: {}".format(item, e))
+            result.written = [item for item in result.written if item not in result.rolled_back]
+        return result
+
+    def _encoded_equal(self, item, value, byte_val):
+        try:
+            return self.CODECS[item].encode(value) == byte_val
+        except (TypeError, ValueError):
+            return False
+
+    def _known_value(self, item):
+        """Get a value without reading the device, from the cache or for the time from the clock model
+
+        :param item: name of item
+        :return: tuple of (found, value)
+        """
+        found, val = self.cache.get(item)
+        if not found and item == 'time' and self.clock_model.calibrated:
+            return True, self.clock_model.device_time()
+        return found, val
+
+    def sync_clock(self, threshold):
+        """Read the device clock and set it to local time if it is off by more than threshold seconds
+
+        :param threshold: seconds the device clock may be off by
+        :return: seconds the device clock was ahead of local time before any correction
+        """
+        self.read('time', fresh=True)
+        offset = self.clock_model.offset()
+        if abs(offset) > threshold:
+            self.logger.info("device clock {:.0f}s off, setting it to local time".format(offset))
+            self.time = self.clock_model.local_time()
+        return offset
+
+    def start_notify(self, callback):
+        """Subscribe to changes of all attributes that support notify
+
+        The callback is called from the BLE thread with the item name and converted value.
+        Notifications are best effort, the subscription ends when the device disconnects.
+
+        :param callback: function taking (item, value)
+        :return:
+        """
+        for item in self.NOTIFY_ATTRIBUTES:
+            characteristic = self._get_characteristic(self.ATTRIBUTES[item]['uuid'])
+            characteristic.start_notify(self._notify_handler(item, callback))
+        self.notifying = True
+
+    def stop_notify(self):
+        """Unsubscribe from attribute changes
+
+        """
+        self.notifying = False
+        for item in self.NOTIFY_ATTRIBUTES:
+            characteristic = self._get_characteristic(self.ATTRIBUTES[item]['uuid'])
+            characteristic.stop_notify()
+
+    def _notify_handler(self, item, callback):
+        """Build the function to decode notifications for an item, bluez passes them as a str
+
+        :param item: name of item
+        :param callback: function taking (item, value)
+        :return:
+        """
+        codec = self.CODECS[item]
+        converter = self.CONVERTERS.get(item)
+
+        def on_change(raw):
+            try:
+                val = codec.decode(raw)
+            except FrameError as e:
+                self.logger.error("bad notification for {}: {}".format(item, e))
+                return
+            self.cache.set(item, val)
+            callback(item, converter(val) if converter else val)
+
+        return on_change
 
     def _parse_value(self, item, val):
         """Parse values from the raw data for an item
@@ -228,57 +618,130 @@ class TimerService(ServiceBase):
         :param val: raw value
         :return:
         """
+        return self.CODECS[item].decode(val)
 
-        # get attribute details from array
-        attr = self.ATTRIBUTES[item]
+    def _write_attr(self, item, value):
+        """Helper function to write an attribute using related codec
 
-        results = []
-        idx = 0
-        for el in attr['format']:
-            # save result if it's not a placeholder char
-            if type(el) == str:
-                results.append(val[idx])
-            idx += 1
+        :param item: name of item
+        :param value:
+        :return:
+        """
+        codec = self.CODECS[item]
+        byte_val = codec.encode(value)
 
-        # if we only have one result return that, otherwise return list
-        if len(results) == 1:
-            return results[0]
-        return results
+        # write the value, dropping the cached value until we know it succeeded
+        self.cache.invalidate(item)
+        res = self._write_raw(item, byte_val)
+        self.cache.set(item, codec.decode(byte_val))
+        if item == 'time':
+            self.clock_model.corrected(value)
+        return res
 
-    def _write_attr(self, attr, value):
-        """Helper function to write an attribute using related format array
+    def rebind(self, discover=False):
+        """Find the services and index the characteristic of each attribute by uuid
 
-        :param attr:
-        :param value:
+        Needs to be called when the device reconnects, this is done automatically
+        when a GATT operation on an indexed characteristic fails.
+
+        :param discover: run service discovery first, e.g. when it was skipped for a cached layout
+        """
+        if discover:
+            self.logger.debug("discovering services of {}".format(self.device.name))
+            self.discover(self.device)
+            self.discovered = True
+        timer = self.device.find_service(TIMER_SERVICE_UUID)
+        battery = self.device.find_service(BATTERY_SERVICE_UUID)
+        if timer is None:
+            raise RuntimeError('Failed to find expected Timer service!')
+        if battery is None:
+            raise RuntimeError('Failed to find expected Battery service!')
+
+        self._timer = timer
+        self._battery = battery
+        services = {
+            'timer': timer,
+            'battery': battery
+        }
+        self._characteristics = {
+            attr['uuid']: services[attr['service']].find_characteristic(attr['uuid'])
+            for attr in self.ATTRIBUTES.values()
+        }
+
+    def _read_raw(self, item):
+        """Read the raw value of an item, re-indexing once if the handle is stale
+
+        :param item: name of item
+        :return: raw value
+        """
+        uuid = self.ATTRIBUTES[item]['uuid']
+        try:
+            return self._timed('read', item, self._get_characteristic(uuid).read_value)
+        except Exception as e:
+            self._rebind_stale('read', item, e)
+            return self._timed('read', item, self._get_characteristic(uuid).read_value)
+
+    def _write_raw(self, item, byte_val):
+        """Write the raw value of an item, re-indexing once if the handle is stale
+
+        :param item: name of item
+        :param byte_val: raw value
         :return:
         """
-        # convert to list for ease
-        if type(value) != list:
-            value = [value]
-
-        # build the required format
-        idx = 0
-        byte_val = bytearray()
-        for el in attr['format']:
-            if type(el) == int:
-                # add char items as is
-                byte_val.append(el)
-            else:
-                # add properties from the value list passed
-                byte_val.append(value[idx])
-                idx += 1
+        uuid = self.ATTRIBUTES[item]['uuid']
+        try:
+            return self._timed('write', item, self._get_characteristic(uuid).write_value, byte_val)
+        except Exception as e:
+            self._rebind_stale('write', item, e)
+            return self._timed('write', item, self._get_characteristic(uuid).write_value, byte_val)
 
-        # init service and characteristic
-        characteristic = self._get_characteristic(attr['service'], attr['uuid'])
-        # write the value
-        return characteristic.write_value(byte_val)
+    def _rebind_stale(self, op, item, error):
+        """Re-index the characteristics after a failed GATT operation, if its handle was stale
 
-    def _get_characteristic(self, service, uuid):
-        """Find a characteristic for a service from the uuid
+        Called from an except block, any other failure is raised again as is.
 
+        :param op: 'read' or 'write'
+        :param item: name of item
+        :param error: exception of the failed operation
+        :return:
+        """
+        if not _is_stale(error):
+            raise error
+        self.logger.debug("{} {} failed, rebinding: {}".format(op, item, error))
+        try:
+            self.rebind(discover=not self.discovered)
+        except Exception as e:
+            self.logger.debug("rebind failed: {}".format(e))
+            raise error
+
+    def _timed(self, op, item, func, *args):
+        """Run a GATT operation, recording its time or failure in the metrics
+
+        :param op: 'read' or 'write'
+        :param item: name of item
+        :param func: characteristic function
+        :param args: arguments for the function
+        :return: result of the function
         """
-        s = getattr(self, '_{}'.format(service))
-        return s.find_characteristic(uuid)
+        if self.metrics is None:
+            return func(*args)
+        start = time.monotonic()
+        try:
+            result = func(*args)
+        except Exception:
+            self.metrics.inc('ble_errors_total', op=op, attribute=item)
+            raise
+        self.metrics.observe('ble_{}_seconds'.format(op), time.monotonic() - start, attribute=item)
+        return result
+
+    def _get_characteristic(self, uuid):
+        """Find a characteristic from the uuid index
+
+        """
+        characteristic = self._characteristics.get(uuid)
+        if characteristic is None:
+            raise StaleHandleError('Failed to find characteristic {}'.format(uuid))
+        return characteristic
 
     @property
     def on(self):
@@ -286,11 +749,7 @@ class TimerService(ServiceBase):
 
         :return:
         """
-        # use getattr helper
-        val = self.__getattr__('on')
-        if val == 1:
-            return True
-        return False
+        return self.read('on')
 
     @property
     def manual_time_left(self):
@@ -302,20 +761,13 @@ class TimerService(ServiceBase):
         'i\x03\x01\x00\t' - on 9 min
         :return:
         """
-        # use getattr helper
-        val = self.__getattr__('manual_time_left')
-
-        # check if manual mode is turned on
-        if val[0] == 1:
-            return val[1]
-        return 0
+        return self.read('manual_time_left')
 
     @property
     def all(self):
         """Return dict of all attributes
 
+        Attributes that failed to read are listed in the errors of the returned Snapshot.
+
         """
-        result = {}
-        for attr in self.ATTRIBUTES:
-            result[attr] = getattr(self, attr)
-        return result
+        return self.read_many()
@@ -11,23 +11,29 @@ import voluptuous as vol
 
 from homeassistant.components import mqtt
 import homeassistant.helpers.config_validation as cv
+from homeassistant.core import callback
 from homeassistant.helpers.dispatcher import (
-    async_dispatcher_connect, dispatcher_send)
+    async_dispatcher_connect, async_dispatcher_send)
 from homeassistant.components.mqtt import CONF_STATE_TOPIC, CONF_COMMAND_TOPIC
 from homeassistant.helpers.entity import Entity
 
 _LOGGER = logging.getLogger(__name__)
 
+REQUIREMENTS = ['aquasystems-driver==0.0.3']
+
 DEPENDENCIES = ['mqtt']
 
 DATA_AQUASYSTEMS = 'aquasystems'
+DATA_AQUASYSTEMS_DEFAULT_DEVICE = 'aquasystems_default_device'
 DOMAIN = 'aquasystems'
 
 DEFAULT_NAME = 'Aqua Timer'
-DEFAULT_TOPIC = '$SYS/broker/aquatimer/info'
-DEFAULT_COMMAND_TOPIC = '$SYS/broker/aquatimer/command'
+DEFAULT_TOPIC = 'aquatimer/+/info'
+DEFAULT_COMMAND_TOPIC = 'aquatimer/+/command'
+
+TOPIC_META = 'meta'
 
-SIGNAL_UPDATE_AQUASYSTEMS = 'aquasystems_update'
+SIGNAL_UPDATE_AQUASYSTEMS = 'aquasystems_update_{}_{}'
 
 ATTR_BATTERY = 'battery'
 ATTR_ON = 'on'
@@ -63,11 +69,6 @@ DEVICE_MAP = {
     ATTR_RAIN_DELAY_TIME: ['Rain Delay', 'mdi:lock-clock', 'days'],
 }
 
-UPDATE_PAYLOAD = json.dumps({
-    'cmd': 'get',
-    'item': 'all'
-})
-
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
         vol.Required(CONF_STATE_TOPIC, default=DEFAULT_TOPIC): cv.string,
@@ -75,43 +76,137 @@ CONFIG_SCHEMA = vol.Schema({
     }),
 }, extra=vol.ALLOW_EXTRA)
 
+PAYLOAD_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_BATTERY): cv.positive_int,
+    vol.Optional(ATTR_ON): vol.Coerce(bool),
+    vol.Optional(ATTR_STATUS): cv.positive_int,
+    vol.Optional(ATTR_TIME): vol.All(cv.ensure_list, [cv.positive_int]),
+    vol.Optional(ATTR_CYCLE1_START): vol.All(cv.ensure_list, [cv.positive_int]),
+    vol.Optional(ATTR_CYCLE2_START): vol.All(cv.ensure_list, [cv.positive_int]),
+    vol.Optional(ATTR_CYCLE_DUR): cv.positive_int,
+    vol.Optional(ATTR_CYCLE_FREQ): cv.positive_int,
+    vol.Optional(ATTR_MANUAL_TIME_LEFT): cv.positive_int,
+    vol.Optional(ATTR_RAIN_DELAY_TIME): cv.positive_int,
+}, extra=vol.ALLOW_EXTRA)
+
+MQTT_PAYLOAD = vol.Schema(vol.All(json.loads, PAYLOAD_SCHEMA))
+
+# value types checked by validate_payload, 'list' is a list of positive ints
+PAYLOAD_TYPES = {
+    ATTR_BATTERY: int,
+    ATTR_ON: bool,
+    ATTR_STATUS: int,
+    ATTR_TIME: list,
+    ATTR_CYCLE1_START: list,
+    ATTR_CYCLE2_START: list,
+    ATTR_CYCLE_DUR: int,
+    ATTR_CYCLE_FREQ: int,
+    ATTR_MANUAL_TIME_LEFT: int,
+    ATTR_RAIN_DELAY_TIME: int,
+}
+
 
-MQTT_PAYLOAD = vol.Schema(vol.All(json.loads, vol.Schema({
-    vol.Required(ATTR_BATTERY): cv.positive_int,
-    vol.Required(ATTR_ON): vol.Coerce(bool),
-    vol.Required(ATTR_STATUS): cv.positive_int,
-    vol.Required(ATTR_TIME): vol.All(cv.ensure_list, [cv.positive_int]),
-    vol.Required(ATTR_CYCLE1_START): vol.All(cv.ensure_list, [cv.positive_int]),
-    vol.Required(ATTR_CYCLE2_START): vol.All(cv.ensure_list, [cv.positive_int]),
-    vol.Required(ATTR_CYCLE_DUR): cv.positive_int,
-    vol.Required(ATTR_CYCLE_FREQ): cv.positive_int,
-    vol.Required(ATTR_MANUAL_TIME_LEFT): cv.positive_int,
-    vol.Required(ATTR_RAIN_DELAY_TIME): cv.positive_int,
-}, extra=vol.ALLOW_EXTRA)))
+def validate_payload(data):
+    """Validate a decoded payload with a single pass over its values.
+
+    Payloads that already have the expected types are returned as is, anything else
+    goes through PAYLOAD_SCHEMA to be coerced or rejected with its error message.
+    """
+    if type(data) is not dict:
+        return PAYLOAD_SCHEMA(data)
+    for key, value in data.items():
+        kind = PAYLOAD_TYPES.get(key)
+        if kind is None:
+            continue
+        value_type = type(value)
+        if kind is int:
+            if value_type is not int or value < 0:
+                return PAYLOAD_SCHEMA(data)
+        elif kind is bool:
+            if value_type is not bool:
+                return PAYLOAD_SCHEMA(data)
+        elif value_type is not list:
+            return PAYLOAD_SCHEMA(data)
+        else:
+            for item in value:
+                if type(item) is not int or item < 0:
+                    return PAYLOAD_SCHEMA(data)
+    return data
 
 
 async def async_setup(hass, config):
 
     conf = config[DOMAIN]
+    # attribute values per device id
     hass.data[DATA_AQUASYSTEMS] = {}
-
-    async def message_received(topic, payload, qos):
-        """Handle new MQTT messages."""
-        _LOGGER.info("aquasystems payload {}".format(payload))
+    # binary encoding with the attribute layout announced by the service per device id
+    encodings = {}
+    # last binary payload per device id and topic name received before the layout
+    pending = {}
+
+    # every device publishes on topics next to its state topic, one wildcard covers them all
+    base_topic, state_name = conf[CONF_STATE_TOPIC].rsplit('/', 1)
+    if '+' not in base_topic:
+        hass.data[DATA_AQUASYSTEMS_DEFAULT_DEVICE] = base_topic.rsplit('/', 1)[-1]
+
+    def meta_received(device_id, payload):
+        """Handle the payload encoding announced by the service."""
         try:
-            data = MQTT_PAYLOAD(payload)
-            hass.data[DATA_AQUASYSTEMS] = data
-            dispatcher_send(hass, SIGNAL_UPDATE_AQUASYSTEMS)
-        except vol.MultipleInvalid as error:
+            layout = json.loads(payload.decode('utf-8')).get('attributes')
+        except (ValueError, AttributeError) as error:
+            _LOGGER.debug("Skipping malformatted meta data: %s", error)
+            return
+        if not layout:
+            encodings.pop(device_id, None)
+            return
+        # imported here, the requirement is installed by Home Assistant after this module is loaded
+        from aquasystems.encoding import BinaryEncoding
+        encodings[device_id] = BinaryEncoding(layout)
+        # retained payloads may have arrived before the meta data
+        for name, buffered in pending.pop(device_id, {}).items():
+            payload_received(device_id, name, buffered)
+
+    def payload_received(device_id, name, payload):
+        """Decode an attribute or info payload and signal the sensors."""
+        _LOGGER.debug("aquasystems %s payload %s", device_id, payload)
+        try:
+            if payload[:1] == b'{':
+                # newer than any binary payload held for the device
+                pending.pop(device_id, None)
+                data = validate_payload(json.loads(payload.decode('utf-8')))
+            elif device_id in encodings:
+                data = validate_payload(encodings[device_id].loads(payload))
+            else:
+                _LOGGER.debug("Holding binary payload until meta data")
+                pending.setdefault(device_id, {})[name] = payload
+                return
+        except (vol.Invalid, ValueError, IndexError, KeyError) as error:
             _LOGGER.debug(
                 "Skipping update because of malformatted data: %s", error)
             return
 
+        # payloads may only hold some attributes, only signal the sensors whose value changed
+        state = hass.data[DATA_AQUASYSTEMS].setdefault(device_id, {})
+        for attr, value in data.items():
+            if attr in DEVICE_MAP and state.get(attr) != value:
+                state[attr] = value
+                async_dispatcher_send(
+                    hass, SIGNAL_UPDATE_AQUASYSTEMS.format(device_id, attr), value)
+
+    async def message_received(topic, payload, qos):
+        """Handle new MQTT messages."""
+        device_id, name = topic.rsplit('/', 2)[-2:]
+        if name == TOPIC_META:
+            meta_received(device_id, payload)
+        elif name == state_name or name in DEVICE_MAP:
+            payload_received(device_id, name, payload)
+
     await mqtt.async_subscribe(
         hass,
-        conf[CONF_STATE_TOPIC],
+        '{}/+'.format(base_topic),
         message_received,
-        1
+        1,
+        encoding=None
     )
 
     return True
@@ -120,10 +215,11 @@ async def async_setup(hass, config):
 class AquaTimerSensor(Entity):
     """Representation of an Aqua Systems BlueTooth Timer updated via MQTT."""
 
-    def __init__(self, name, sensor_type):
+    def __init__(self, name, device_id, sensor_type):
         """Initialize the sensor."""
         self._state = None
         self._name = name
+        self._device_id = device_id
         self._sensor_type = sensor_type
 
     @property
@@ -146,25 +242,30 @@ class AquaTimerSensor(Entity):
 
         return self._state
 
-    async def async_update(self):
-        data = self.hass.data[DATA_AQUASYSTEMS]
-        _LOGGER.info("data {}".format(data))
-        if self._sensor_type in data:
-            self._state = data[self._sensor_type]
+    @property
+    def should_poll(self):
+        """Values are pushed by the MQTT messages."""
+        return False
 
     async def async_added_to_hass(self):
         """Register callbacks."""
+        state = self.hass.data[DATA_AQUASYSTEMS].get(self._device_id, {})
+        self._state = state.get(self._sensor_type)
         async_dispatcher_connect(
-            self.hass, SIGNAL_UPDATE_AQUASYSTEMS, self._update_callback)
+            self.hass,
+            SIGNAL_UPDATE_AQUASYSTEMS.format(self._device_id, self._sensor_type),
+            self._update_callback)
 
-    async def _update_callback(self):
-        """Call update method."""
-        self.async_schedule_update_ha_state(True)
+    @callback
+    def _update_callback(self, value):
+        """Store the new value and write the state."""
+        self._state = value
+        self.async_schedule_update_ha_state()
 
     @property
     def icon(self):
         """Icon to use in the frontend, if any."""
-        _LOGGER.info("icon for {}".format(self._sensor_type))
+        _LOGGER.debug("icon for %s", self._sensor_type)
         if self._sensor_type == ATTR_STATUS:
             if not self._state:
                 return None
@@ -9,7 +9,7 @@ import logging
 import voluptuous as vol
 
 from custom_components.aquasystems import (
-    AquaTimerSensor, ATTR_STATUS, DEVICE_MAP)
+    AquaTimerSensor, ATTR_STATUS, DATA_AQUASYSTEMS_DEFAULT_DEVICE, DEVICE_MAP)
 
 import homeassistant.helpers.config_validation as cv
 from homeassistant.components.sensor import PLATFORM_SCHEMA
@@ -20,16 +20,26 @@ _LOGGER = logging.getLogger(__name__)
 
 DEPENDENCIES = ['aquasystems']
 
+CONF_DEVICE_ID = 'device_id'
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
-    vol.Required(CONF_SENSOR_TYPE, default=ATTR_STATUS): vol.In(DEVICE_MAP)
+    vol.Required(CONF_SENSOR_TYPE, default=ATTR_STATUS): vol.In(DEVICE_MAP),
+    vol.Optional(CONF_DEVICE_ID): cv.string
 })
 
 
 async def async_setup_platform(hass, config, async_add_entities,
                                discovery_info=None):
     """Set up MQTT room Sensor."""
+    # without a device id use the device of the component state topic
+    device_id = config.get(CONF_DEVICE_ID, hass.data.get(DATA_AQUASYSTEMS_DEFAULT_DEVICE))
+    if device_id is None:
+        _LOGGER.error("device_id is required when the state topic has a wildcard")
+        return
+
     async_add_entities([AquaTimerSensor(
         config.get(CONF_NAME),
+        device_id,
         config.get(CONF_SENSOR_TYPE),
     )])
 
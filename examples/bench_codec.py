@@ -0,0 +1,129 @@
+import argparse
+import timeit
+
+from aquasystems.timer import TimerService
+
+# sample raw values as read from the device
+SAMPLES = {
+    'battery': b'\x05',
+    'on': b'R\x01\x01',
+    'status': b'a\x01\x02',
+    'time': b'T\x04\x15\x17\x04\x04',
+    'cycle1_start': b'd\x02\x05\x1e',
+    'cycle2_start': b'e\x02\x05\x1e',
+    'cycle_duration': b'b\x02\x00\x1d',
+    'cycle_frequency': b'c\x03\x00\x04\x7f',
+    'manual_time_left': b'i\x03\x01\x00\x05',
+    'rain_delay_time': b'f\x01\x00',
+}
+
+
+def legacy_parse(attr, val):
+    """Format list walk used before the codecs were compiled
+
+    """
+    results = []
+    idx = 0
+    for el in attr['format']:
+        if type(el) == str:
+            results.append(val[idx])
+        idx += 1
+    if len(results) == 1:
+        return results[0]
+    return results
+
+
+def legacy_write(attr, value):
+    """Format list walk used before the codecs were compiled
+
+    """
+    if type(value) != list:
+        value = [value]
+    idx = 0
+    byte_val = bytearray()
+    for el in attr['format']:
+        if type(el) == int:
+            byte_val.append(el)
+        else:
+            byte_val.append(value[idx])
+            idx += 1
+    return byte_val
+
+
+# (attribute details, codec, raw value, decoded value) for each sample
+CASES = [
+    (TimerService.ATTRIBUTES[item], TimerService.CODECS[item], raw, TimerService.CODECS[item].decode(raw))
+    for item, raw in sorted(SAMPLES.items())
+]
+
+
+class DbusArray(list):
+    """Stand in for the dbus.Array, a list subclass, the bluez provider returns reads as
+
+    """
+
+
+LIST_CASES = [(attr, codec, DbusArray(raw), val) for attr, codec, raw, val in CASES]
+
+
+def legacy_decode():
+    for attr, codec, raw, val in CASES:
+        legacy_parse(attr, raw)
+
+
+def legacy_decode_list():
+    for attr, codec, raw, val in LIST_CASES:
+        legacy_parse(attr, raw)
+
+
+def codec_decode():
+    for attr, codec, raw, val in CASES:
+        codec.decode(raw)
+
+
+def codec_decode_list():
+    # reads through the bluez provider return a dbus.Array, a list of ints
+    for attr, codec, raw, val in LIST_CASES:
+        codec.decode(raw)
+
+
+def legacy_encode():
+    for attr, codec, raw, val in CASES:
+        legacy_write(attr, val)
+
+
+def codec_encode():
+    for attr, codec, raw, val in CASES:
+        codec.encode(val)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark attribute parsing and encoding.')
+    parser.add_argument('--number', help='Iterations per repeat', type=int, default=20000)
+    parser.add_argument('--repeat', help='Number of repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    # make sure both paths agree before timing them
+    for item, raw in SAMPLES.items():
+        attr = TimerService.ATTRIBUTES[item]
+        assert legacy_parse(attr, raw) == TimerService.CODECS[item].decode(raw), item
+        assert TimerService.CODECS[item].decode(DbusArray(raw)) == TimerService.CODECS[item].decode(raw), item
+        assert legacy_parse(attr, DbusArray(raw)) == legacy_parse(attr, raw), item
+        assert TimerService.CODECS[item].decode(raw.decode('latin-1')) == TimerService.CODECS[item].decode(raw), item
+        if attr['can_set']:
+            assert legacy_write(attr, legacy_parse(attr, raw)) == raw, item
+            assert TimerService.CODECS[item].encode(legacy_parse(attr, raw)) == raw, item
+
+    benchmarks = [
+        ('legacy decode', legacy_decode),
+        ('codec decode', codec_decode),
+        ('legacy list', legacy_decode_list),
+        ('codec list', codec_decode_list),
+        ('legacy encode', legacy_encode),
+        ('codec encode', codec_encode),
+    ]
+    for name, func in benchmarks:
+        best = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+        per_frame = best / (args.number * len(CASES)) * 1e6
+        print('{:14s} {:.3f}s per {} passes, {:.3f}us per frame'.format(name, best, args.number, per_frame))
@@ -0,0 +1,43 @@
+import argparse
+import timeit
+
+from aquasystems.encoding import ENCODINGS
+
+# payloads as published by the MQTT service
+PAYLOADS = {
+    'snapshot': {
+        'battery': 87,
+        'on': True,
+        'status': 2,
+        'time': [21, 23, 4],
+        'cycle1_start': [5, 30],
+        'cycle2_start': [255, 0],
+        'cycle_duration': 29,
+        'cycle_frequency': 4,
+        'manual_time_left': 0,
+        'rain_delay_time': 0,
+    },
+    'attribute': {
+        'cycle1_start': [5, 30]
+    },
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark MQTT payload encodings.')
+    parser.add_argument('--number', help='Iterations per repeat', type=int, default=20000)
+    parser.add_argument('--repeat', help='Number of repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    print('{:8s} {:10s} {:>6s} {:>10s} {:>10s}'.format('encoding', 'payload', 'bytes', 'encode us', 'decode us'))
+    for name, encoding_class in sorted(ENCODINGS.items()):
+        encoding = encoding_class()
+        for payload_name, payload in sorted(PAYLOADS.items()):
+            data = encoding.dumps(payload)
+            assert encoding.loads(data) == payload, (name, payload_name)
+
+            encode = min(timeit.repeat(lambda: encoding.dumps(payload), number=args.number, repeat=args.repeat))
+            decode = min(timeit.repeat(lambda: encoding.loads(data), number=args.number, repeat=args.repeat))
+            print('{:8s} {:10s} {:6d} {:10.2f} {:10.2f}'.format(
+                name, payload_name, len(data), encode / args.number * 1e6, decode / args.number * 1e6))
@@ -0,0 +1,60 @@
+import argparse
+import json
+import timeit
+
+import voluptuous as vol
+
+from custom_components.aquasystems import MQTT_PAYLOAD, validate_payload
+
+# payloads as received by the Home Assistant component
+PAYLOADS = {
+    'snapshot': json.dumps({
+        'battery': 87,
+        'on': True,
+        'status': 2,
+        'time': [21, 23, 4],
+        'cycle1_start': [5, 30],
+        'cycle2_start': [255, 0],
+        'cycle_duration': 29,
+        'cycle_frequency': 4,
+        'manual_time_left': 0,
+        'rain_delay_time': 0,
+    }),
+    'attribute': json.dumps({
+        'cycle1_start': [5, 30]
+    }),
+    'invalid': json.dumps({
+        'battery': -1
+    }),
+}
+
+
+def schema(payload):
+    try:
+        return MQTT_PAYLOAD(payload)
+    except vol.Invalid:
+        return None
+
+
+def fast(payload):
+    try:
+        return validate_payload(json.loads(payload))
+    except vol.Invalid:
+        return None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark Home Assistant payload validation.')
+    parser.add_argument('--number', help='Iterations per repeat', type=int, default=20000)
+    parser.add_argument('--repeat', help='Number of repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    print('{:10s} {:>10s} {:>10s}'.format('payload', 'schema us', 'fast us'))
+    for payload_name, payload in sorted(PAYLOADS.items()):
+        assert schema(payload) == fast(payload), payload_name
+
+        schema_time = min(timeit.repeat(lambda: schema(payload), number=args.number, repeat=args.repeat))
+        fast_time = min(timeit.repeat(lambda: fast(payload), number=args.number, repeat=args.repeat))
+        print('{:10s} {:10.2f} {:10.2f}'.format(
+            payload_name, schema_time / args.number * 1e6, fast_time / args.number * 1e6))
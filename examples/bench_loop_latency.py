@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import sys
+import time
+
+from aquasystems.commands import PRIORITY_GET, PRIORITY_SET
+from aquasystems.mqtt import TimerMqttService
+from aquasystems.timer import Snapshot, TimerService
+
+
+class SlowTimerService:
+    """Stand in for TimerService where every GATT operation blocks for a while
+
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.values = {item: 0 for item in TimerService.ATTRIBUTES}
+
+    def read(self, item, fresh=False):
+        time.sleep(self.delay)
+        return self.values[item]
+
+    def read_many(self, items=None, timeout=None, fresh=False):
+        return Snapshot({item: self.read(item) for item in items or self.values})
+
+    def __getattr__(self, item):
+        return self.read(item)
+
+    def __setattr__(self, item, value):
+        if item in TimerService.ATTRIBUTES:
+            time.sleep(self.delay)
+            self.values[item] = value
+        else:
+            self.__dict__[item] = value
+
+
+class NullMqttClient:
+    """Stand in for the MQTT client that only counts publishes
+
+    """
+
+    def __init__(self):
+        self.published = 0
+
+    async def publish(self, topic, message, qos=None, retain=None):
+        self.published += 1
+
+
+async def measure_lag(service, interval, duration):
+    """Measure how late the loop wakes up from short sleeps while commands run
+
+    """
+    worst = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.monotonic() - start - interval)
+    service.stop()
+    return worst
+
+
+async def main(args):
+    service = TimerMqttService('mqtt://127.0.0.1', 'Fake', start=False)
+    service.mqtt_client = NullMqttClient()
+    timer = service.devices['fake']
+    timer.timer_service = SlowTimerService(args.delay)
+
+    for i in range(args.commands):
+        await timer.command_queue.put({'cmd': 'set', 'item': 'cycle_duration', 'value': i % 60}, PRIORITY_SET)
+        await timer.command_queue.put({'cmd': 'get', 'item': 'battery'}, PRIORITY_GET)
+
+    consumer = asyncio.ensure_future(service._consumer(timer))
+    worst = await measure_lag(service, args.interval, args.duration)
+    consumer.cancel()
+    return worst, service.mqtt_client.published
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Measure event loop latency while BLE operations are slow.')
+    parser.add_argument('--delay', help='Seconds each GATT operation blocks', type=float, default=0.5)
+    parser.add_argument('--commands', help='Number of set/get command pairs to queue', type=int, default=5)
+    parser.add_argument('--interval', help='Loop probe interval in seconds', type=float, default=0.01)
+    parser.add_argument('--duration', help='Seconds to measure for', type=float, default=5)
+    parser.add_argument('--max_lag', help='Fail if loop lag exceeds this many seconds', type=float, default=0.1)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    worst, published = loop.run_until_complete(main(args))
+    print('published {} payloads, worst loop lag {:.1f}ms'.format(published, worst * 1000))
+    if worst > args.max_lag:
+        print('loop lag exceeded {:.1f}ms'.format(args.max_lag * 1000))
+        sys.exit(1)
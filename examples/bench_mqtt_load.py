@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import itertools
+import json
+import random
+import sys
+import time
+
+from hbmqtt.broker import Broker
+from hbmqtt.client import MQTTClient
+from hbmqtt.mqtt.constants import QOS_1
+
+from aquasystems.mqtt import TimerMqttService
+from aquasystems.simulator import SimulatedDevice, SimulatedProvider
+from aquasystems.timer import TimerService
+
+# weights of the commands sent, 'set' commands write a new value each time
+DEFAULT_MIX = 'get:battery=4,get:all=1,set:cycle_duration=2,set:cycle1_start=1'
+
+
+def parse_mix(mix):
+    """Parse a command mix e.g. 'get:battery=4,set:cycle_duration=1'
+
+    :param mix: comma separated cmd:item=weight
+    :return: list of (cmd, item, weight)
+    """
+    commands = []
+    for part in mix.split(','):
+        command, weight = part.split('=')
+        cmd, item = command.split(':')
+        if cmd not in ('get', 'set'):
+            raise ValueError('unknown command {}'.format(cmd))
+        if item != 'all' and item not in TimerService.ATTRIBUTES:
+            raise ValueError('unknown item {}'.format(item))
+        commands.append((cmd, item, float(weight)))
+    return commands
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def pick(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': pick(0.5),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': samples[-1]
+    }
+
+
+class LoadClient:
+    """Sends commands to the service and matches them to the publishes they cause
+
+    A command is answered by the next publish on the topic of its item, the info topic
+    for 'all'. Commands merged by the service are all answered by the same publish.
+    Commands sent in batches carry a correlation id and are answered by their ack on
+    the response topic instead, which also reports the BLE time of each.
+
+    """
+
+    def __init__(self, service, url, seed):
+        self.service = service
+        self.url = url
+        self.client = MQTTClient()
+        self.random = random.Random(seed)
+        self.counter = 0
+        self.sent = 0
+        # pending commands per topic as (sent time, command name)
+        self.pending = collections.defaultdict(collections.deque)
+        self.latencies = collections.defaultdict(list)
+        self.received = 0
+        # batched commands waiting for their ack by correlation id as (sent time, command name)
+        self.acks = {}
+        self.ble_latencies = collections.defaultdict(list)
+        self.failed = 0
+
+    async def connect(self):
+        await self.client.connect(self.url)
+        await self.client.subscribe([('{}/+/+'.format(self.service.TOPIC_PREFIX), QOS_1)])
+
+    def response_topic(self, timer, item):
+        if item == 'all':
+            return self.service.topic(timer, TimerMqttService.INFO_TOPIC)
+        return self.service.topic(timer, TimerMqttService.ATTR_TOPICS.get(item, item))
+
+    def build(self, cmd, item):
+        command = {'cmd': cmd, 'item': item}
+        if cmd == 'set':
+            # a value different from the last write so the refresh is published
+            self.counter += 1
+            if len(TimerService.CODECS[item].fields) == 1:
+                command['value'] = 1 + self.counter % 60
+            else:
+                command['value'] = [self.counter % 24, self.counter % 60]
+        return command
+
+    async def send(self, timer, cmd, item):
+        command = self.build(cmd, item)
+        self.pending[self.response_topic(timer, item)].append((time.monotonic(), '{}:{}'.format(cmd, item)))
+        self.sent += 1
+        await self.client.publish(
+            self.service.topic(timer, TimerMqttService.COMMAND_TOPIC),
+            json.dumps(command).encode('utf-8'),
+            qos=QOS_1
+        )
+
+    async def send_batch(self, timer, commands):
+        """Send several commands in one message, each with a correlation id
+
+        :param timer: TimerDevice
+        :param commands: list of (cmd, item)
+        :return:
+        """
+        batch = []
+        now = time.monotonic()
+        for cmd, item in commands:
+            command = self.build(cmd, item)
+            command['id'] = self.sent
+            self.acks[self.sent] = (now, '{}:{}'.format(cmd, item))
+            self.sent += 1
+            batch.append(command)
+        await self.client.publish(
+            self.service.topic(timer, TimerMqttService.COMMAND_TOPIC),
+            json.dumps(batch).encode('utf-8'),
+            qos=QOS_1
+        )
+
+    def receive_ack(self, msg, now):
+        for result in json.loads(msg.data.decode('utf-8'))['results']:
+            if result['id'] not in self.acks:
+                continue
+            sent, name = self.acks.pop(result['id'])
+            self.latencies[name].append(now - sent)
+            if result['ok']:
+                self.ble_latencies[name].append(result['ble_seconds'])
+            else:
+                self.failed += 1
+
+    async def receive(self):
+        while True:
+            msg = await self.client.deliver_message()
+            now = time.monotonic()
+            if msg.topic.endswith('/' + TimerMqttService.RESPONSE_TOPIC):
+                self.received += 1
+                self.receive_ack(msg, now)
+                continue
+            pending = self.pending.get(msg.topic)
+            if not pending:
+                continue
+            self.received += 1
+            while pending:
+                sent, name = pending.popleft()
+                self.latencies[name].append(now - sent)
+
+    @property
+    def outstanding(self):
+        return sum(len(pending) for pending in self.pending.values()) + len(self.acks)
+
+
+async def drive(client, timers, mix, rate, duration, batch=0):
+    """Send commands at a fixed rate, picking devices and commands at random
+
+    With batch set, commands are sent batch at a time in one message to one device.
+
+    """
+    totals = list(itertools.accumulate(weight for cmd, item, weight in mix))
+    interval = max(1, batch) / rate
+    next_send = time.monotonic()
+    end = next_send + duration
+    while next_send < end:
+        commands = []
+        for i in range(max(1, batch)):
+            cmd, item, weight = mix[bisect.bisect(totals, client.random.random() * totals[-1])]
+            commands.append((cmd, item))
+        if batch:
+            await client.send_batch(client.random.choice(timers), commands)
+        else:
+            await client.send(client.random.choice(timers), *commands[0])
+        next_send += interval
+        await asyncio.sleep(max(0, next_send - time.monotonic()))
+
+
+async def sample_queues(service, interval, samples, start):
+    while True:
+        stats = service.queue_stats
+        samples.append({
+            't': round(time.monotonic() - start, 3),
+            'depth': {device_id: queue['depth'] for device_id, queue in stats.items()}
+        })
+        await asyncio.sleep(interval)
+
+
+async def main(args):
+    loop = asyncio.get_event_loop()
+    url = 'mqtt://127.0.0.1:{}'.format(args.port)
+    broker = Broker({
+        'listeners': {
+            'default': {'type': 'tcp', 'bind': '127.0.0.1:{}'.format(args.port)}
+        },
+        'sys_interval': 0,
+        'auth': {'allow-anonymous': True},
+        'topic-check': {'enabled': False}
+    })
+    await broker.start()
+
+    names = ['Spray-Mist SIM{}'.format(i) for i in range(args.devices)]
+    provider = SimulatedProvider([
+        SimulatedDevice(
+            name,
+            latency={'connect': args.connect_latency, 'read': args.latency, 'write': args.latency},
+            jitter=args.jitter,
+            failure_rate={'read': args.failure_rate, 'write': args.failure_rate},
+            seed=args.seed + i
+        )
+        for i, name in enumerate(names)
+    ])
+    service = TimerMqttService(url, names, start=False, provider=provider)
+    # simulated devices must not end up in the address or discovery caches
+    service.address_cache = None
+    service.discovery_cache = None
+    await loop.run_in_executor(None, service.setup_ble)
+    serving = asyncio.ensure_future(service.serve())
+
+    client = LoadClient(service, url, args.seed)
+    await client.connect()
+    receiving = asyncio.ensure_future(client.receive())
+    # let retained payloads and the start up refresh arrive before measuring
+    await asyncio.sleep(args.warmup)
+    client.pending.clear()
+
+    start = time.monotonic()
+    depth_samples = []
+    sampling = asyncio.ensure_future(sample_queues(service, args.sample_interval, depth_samples, start))
+    await drive(client, list(service.devices.values()), parse_mix(args.mix), args.rate, args.duration, args.batch)
+    send_time = time.monotonic() - start
+
+    drain_end = time.monotonic() + args.drain
+    while client.outstanding and time.monotonic() < drain_end:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - start
+
+    for task in (sampling, receiving, serving):
+        task.cancel()
+    service.stop()
+    await client.client.disconnect()
+    await broker.shutdown()
+
+    all_latencies = [latency for latencies in client.latencies.values() for latency in latencies]
+    answered = len(all_latencies)
+    return {
+        'config': vars(args),
+        'sent': client.sent,
+        'answered': answered,
+        'unanswered': client.outstanding,
+        'failed': client.failed,
+        'publishes_matched': client.received,
+        'send_seconds': send_time,
+        'elapsed_seconds': elapsed,
+        'throughput': answered / elapsed if elapsed else None,
+        'latency': percentiles(all_latencies),
+        'latency_by_command': {name: percentiles(latencies) for name, latencies in sorted(client.latencies.items())},
+        'ble_latency_by_command': {
+            name: percentiles(latencies) for name, latencies in sorted(client.ble_latencies.items())},
+        'queue_depth': depth_samples,
+        'queue_stats': service.queue_stats,
+        'connect_stats': service.connections.stats.as_dict()
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Measure command to publish latency of the MQTT service against simulated timers.')
+    parser.add_argument('--devices', help='Number of simulated timers', type=int, default=1)
+    parser.add_argument('--rate', help='Commands sent per second', type=float, default=20)
+    parser.add_argument('--duration', help='Seconds to send commands for', type=float, default=10)
+    parser.add_argument('--batch', help='Commands per message with correlation ids, 0 to send them one by one',
+                        type=int, default=0)
+    parser.add_argument('--mix', help='Command weights as cmd:item=weight', default=DEFAULT_MIX)
+    parser.add_argument('--latency', help='Seconds per GATT read and write', type=float, default=0.02)
+    parser.add_argument('--connect_latency', help='Seconds to connect a timer', type=float, default=0.5)
+    parser.add_argument('--jitter', help='Maximum random seconds added per GATT operation', type=float, default=0.01)
+    parser.add_argument('--failure_rate', help='Probability of a GATT operation failing', type=float, default=0.0)
+    parser.add_argument('--port', help='Port of the local broker', type=int, default=18830)
+    parser.add_argument('--warmup', help='Seconds to wait before sending commands', type=float, default=2)
+    parser.add_argument('--drain', help='Seconds to wait for outstanding replies', type=float, default=10)
+    parser.add_argument('--sample_interval', help='Seconds between queue depth samples', type=float, default=0.5)
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(main(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    latency = results['latency'] or {}
+    sys.stderr.write('sent {} answered {} p50 {} p95 {} p99 {} throughput {:.1f}/s\n'.format(
+        results['sent'], results['answered'],
+        *['{:.1f}ms'.format(latency[key] * 1000) if key in latency else '-' for key in ('p50', 'p95', 'p99')],
+        results['throughput'] or 0))
@@ -0,0 +1,81 @@
+import argparse
+import collections
+
+from aquasystems.polling import PollScheduler, STATUS_AUTO, STATUS_MANUAL
+from aquasystems.timer import TimerService
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def fixed_polling(args):
+    """Reads per attribute of the previous fixed polling, everything every interval
+
+    """
+    reads = collections.Counter()
+    polls = int(24 * 3600 / args.fixed_interval)
+    for item in TimerService.ATTRIBUTES:
+        # the full read, plus the separate battery read
+        reads[item] += polls * (2 if item == 'battery' else 1)
+    return reads
+
+
+def scheduled_polling(args):
+    """Reads per attribute of the poll scheduler over a day with one manual watering
+
+    :return: tuple of read Counter and the longest seconds manual_time_left went unread while watering
+    """
+    clock = FakeClock()
+    scheduler = PollScheduler(clock=clock)
+    watering_start = args.watering_hour * 3600
+    watering_end = watering_start + args.watering_minutes * 60
+    reads = collections.Counter()
+    last_read = None
+    worst_staleness = 0
+    values = {'status': STATUS_AUTO}
+    scheduler.seen(TimerService.ATTRIBUTES)
+    reads.update(list(TimerService.ATTRIBUTES))
+    while clock.now < 24 * 3600:
+        watering = watering_start <= clock.now < watering_end
+        values['status'] = STATUS_MANUAL if watering else STATUS_AUTO
+        if args.notifying and clock.now == watering_start:
+            # the status change is notified
+            scheduler.seen(['status'])
+        items = scheduler.due(values, args.notifying)
+        reads.update(items)
+        if 'manual_time_left' in items:
+            last_read = clock.now
+        if watering:
+            if last_read is not None:
+                worst_staleness = max(worst_staleness, clock.now - max(last_read, watering_start))
+        clock.now += args.check_interval
+    # the device clock is only read to sync it, other reads are answered by the clock model
+    reads['time'] += int(24 * 3600 / args.clock_sync_interval)
+    return reads, worst_staleness
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compare GATT reads per day of fixed and scheduled polling.')
+    parser.add_argument('--fixed_interval', help='Seconds between polls of the fixed polling', type=float, default=60)
+    parser.add_argument('--check_interval', help='Seconds between scheduler checks', type=float, default=5)
+    parser.add_argument('--clock_sync_interval', help='Seconds between device clock syncs', type=float,
+                        default=6 * 3600)
+    parser.add_argument('--watering_hour', help='Hour a manual watering starts', type=float, default=7)
+    parser.add_argument('--watering_minutes', help='Minutes of manual watering', type=float, default=15)
+    parser.add_argument('--notifying', help='Device notifies changes (stays connected)', action='store_true')
+    args = parser.parse_args()
+
+    fixed = fixed_polling(args)
+    scheduled, staleness = scheduled_polling(args)
+    print('{:18s} {:>8s} {:>10s}'.format('attribute', 'fixed', 'scheduled'))
+    for item in TimerService.ATTRIBUTES:
+        print('{:18s} {:8d} {:10d}'.format(item, fixed[item], scheduled[item]))
+    print('{:18s} {:8d} {:10d}'.format('total', sum(fixed.values()), sum(scheduled.values())))
+    print('manual_time_left unread for at most {:.0f}s while watering'.format(staleness))
@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from aquasystems.commands import PRIORITY_GET, PRIORITY_SET
+from aquasystems.mqtt import TimerMqttService
+from aquasystems.simulator import SimulatedDevice, SimulatedProvider
+from aquasystems.timer import TimerService
+
+
+class RecordingMqttClient:
+    """Stand in for the MQTT client that keeps the publishes with the time they were made
+
+    """
+
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, topic, message, qos=None, retain=None):
+        self.published.append((time.monotonic(), topic))
+
+
+async def main(args):
+    device = SimulatedDevice(
+        'Spray-Mist SIM',
+        latency={'connect': args.connect_latency, 'read': args.latency, 'write': args.latency},
+        seed=args.seed
+    )
+    provider = SimulatedProvider([device])
+    service = TimerMqttService('mqtt://127.0.0.1', device.name, start=False, provider=provider)
+    service.reconnect_min_delay = args.min_delay
+    service.reconnect_max_delay = args.max_delay
+    # the simulated device must not end up in the address or discovery caches
+    service.address_cache = None
+    service.discovery_cache = None
+    service.mqtt_client = RecordingMqttClient()
+    await service.loop.run_in_executor(None, service.setup_ble)
+    timer = next(iter(service.devices.values()))
+    consumer = asyncio.ensure_future(service._consumer(timer))
+
+    await timer.command_queue.put({'cmd': 'get', 'item': 'all'}, PRIORITY_GET)
+    await asyncio.sleep(args.settle)
+
+    # take the device out of range, a command finds the connection gone
+    device.in_range = False
+    device.drop()
+    outage_start = time.monotonic()
+    reads_before = device.stats['read']
+    await timer.command_queue.put({'cmd': 'get', 'item': 'battery'}, PRIORITY_GET)
+    await timer.command_queue.put({'cmd': 'set', 'item': 'cycle_duration', 'value': 42}, PRIORITY_SET)
+    # the device keeps running without us
+    device.set('battery', 50)
+    device.set('status', 2)
+
+    await asyncio.sleep(args.outage)
+    device.in_range = True
+    restored = time.monotonic()
+
+    while not timer.link_up.is_set() or len(timer.command_queue) or timer.pending_sets:
+        await asyncio.sleep(0.01)
+    recovered = time.monotonic()
+    # wait for the commands held during the outage to finish
+    while device.get('cycle_duration') != 42 or 'battery' not in {
+            topic.rsplit('/', 1)[-1] for t, topic in service.mqtt_client.published if t >= restored}:
+        await asyncio.sleep(0.01)
+    commands_done = time.monotonic()
+
+    service.stop()
+    consumer.cancel()
+    timer.timer_service.stop_notify()
+    service.connections.disconnect_all()
+
+    counters = service.metrics.as_dict()
+    return {
+        'config': vars(args),
+        'outage_seconds': restored - outage_start,
+        'recover_seconds': recovered - restored,
+        'commands_done_seconds': commands_done - restored,
+        'reconnect_failures': sum(series['value'] for series in counters.get('reconnect_failures_total', [])),
+        'reads_during_recovery': device.stats['read'] - reads_before,
+        'reads_full_resync': len(TimerService.ATTRIBUTES),
+        'resync_attributes': TimerService.VOLATILE_ATTRIBUTES,
+        'published_battery': timer.published.get('battery'),
+        'published_status': timer.published.get('status')
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Measure how fast the MQTT service recovers a simulated timer that went out of range.')
+    parser.add_argument('--outage', help='Seconds the timer is out of range', type=float, default=3)
+    parser.add_argument('--min_delay', help='Seconds before the first reconnect retry', type=float, default=0.5)
+    parser.add_argument('--max_delay', help='Longest seconds between reconnect retries', type=float, default=4)
+    parser.add_argument('--latency', help='Seconds per GATT read and write', type=float, default=0.02)
+    parser.add_argument('--connect_latency', help='Seconds to connect the timer', type=float, default=0.3)
+    parser.add_argument('--settle', help='Seconds to wait after the first read', type=float, default=1)
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(main(args))
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
@@ -0,0 +1,83 @@
+import argparse
+import time
+
+from aquasystems.simulator import SimulatedDevice, SimulatedProvider
+from aquasystems.timer import TimerService
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(name, func, number):
+    """Time a function number times, counting failures
+
+    """
+    samples = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(number):
+        op_start = time.perf_counter()
+        try:
+            func(i)
+        except Exception:
+            errors += 1
+            continue
+        samples.append(time.perf_counter() - op_start)
+    elapsed = time.perf_counter() - start
+    print('{:8s} {:6d} {:6d} {:9.3f} {:9.3f} {:9.3f} {:10.1f}'.format(
+        name, number, errors,
+        sum(samples) / len(samples) * 1000 if samples else float('nan'),
+        percentile(samples, 0.5) * 1000, percentile(samples, 0.95) * 1000,
+        number / elapsed))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark TimerService against a simulated timer.')
+    parser.add_argument('--number', help='Operations per benchmark', type=int, default=200)
+    parser.add_argument('--latency', help='Seconds per GATT read, write and notify', type=float, default=0.01)
+    parser.add_argument('--jitter', help='Maximum random seconds added per operation', type=float, default=0.005)
+    parser.add_argument('--failure_rate', help='Probability of a GATT operation failing', type=float, default=0.0)
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+    parser.add_argument('--bluez', help='Return reads as lists the way the bluez provider does', action='store_true')
+    args = parser.parse_args()
+
+    device = SimulatedDevice(
+        'Spray-Mist SIM',
+        latency={'read': args.latency, 'write': args.latency, 'notify': args.latency},
+        jitter=args.jitter,
+        failure_rate={'read': args.failure_rate, 'write': args.failure_rate},
+        seed=args.seed,
+        bluez_values=args.bluez
+    )
+    provider = SimulatedProvider([device])
+    provider.get_default_adapter().start_scan()
+    provider.find_device(name=device.name).connect()
+    TimerService.discover(device)
+    timer = TimerService(device)
+
+    notified = []
+    timer.start_notify(lambda item, value: notified.append(item))
+
+    print('{:8s} {:>6s} {:>6s} {:>9s} {:>9s} {:>9s} {:>10s}'.format(
+        'op', 'count', 'errors', 'mean ms', 'p50 ms', 'p95 ms', 'ops/s'))
+    run('read', lambda i: timer.read('battery', fresh=True), args.number)
+    run('all', lambda i: timer.read_many(fresh=True), max(1, args.number // 10))
+    run('write', lambda i: setattr(timer, 'cycle_duration', i % 60), args.number)
+    run('notify', lambda i: device.set('battery', i % 100), args.number)
+
+    # a program whose current values can not be read is not written and reports the read errors
+    device.failure_rate = {'read': 1.0}
+    writes = device.stats['write']
+    result = timer.program({'cycle_duration': 30, 'cycle1_start': [6, 0]})
+    device.failure_rate = {'read': args.failure_rate, 'write': args.failure_rate}
+    assert not result.applied and device.stats['write'] == writes, result.as_dict()
+    print('program with failed reads: {}'.format(result.as_dict()['failed']))
+
+    timer.stop_notify()
+    timer.close()
+    print('notifications received {}, device operations {}'.format(len(notified), dict(device.stats)))
@@ -2,6 +2,7 @@ import argparse
 import logging
 
 from aquasystems.mqtt import TimerMqttService
+from aquasystems.simulator import SimulatedDevice, SimulatedProvider
 
 # setup logging
 logging.basicConfig()
@@ -12,9 +13,16 @@ logging.getLogger().setLevel(logging.DEBUG)
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Run an MQTT Service.')
-    parser.add_argument('--device_id', help='ID of Tap Timer device e.g "Spray-Mist A19E"', default="Spray-Mist A19E")
+    parser.add_argument('--device_id', help='ID of Tap Timer devices e.g "Spray-Mist A19E"', nargs='+',
+                        default=["Spray-Mist A19E"])
     parser.add_argument('--broker_url', help='URL for MQTT broker', default="mqtt://127.0.0.1")
+    parser.add_argument('--simulate', help='Serve simulated timers instead of real devices', action='store_true')
     args = parser.parse_args()
 
+    provider = None
+    if args.simulate:
+        provider = SimulatedProvider([SimulatedDevice(name, latency={'read': 0.05, 'write': 0.05})
+                                      for name in args.device_id])
+
     # run MQTT service
-    tms = TimerMqttService(args.broker_url, args.device_id)
+    tms = TimerMqttService(args.broker_url, args.device_id, provider=provider)
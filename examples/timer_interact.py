@@ -1,5 +1,6 @@
 import Adafruit_BluefruitLE
 import argparse
+from aquasystems.addresses import AddressCache, find_cached_devices, scan_devices
 from aquasystems.timer import TimerService
 
 device_name = None
@@ -9,9 +10,13 @@ ble = Adafruit_BluefruitLE.get_provider()
 
 
 def main():
-    # Clear any cached data because both bluez and CoreBluetooth have issues with
-    # caching data and it going stale.
-    ble.clear_cached_data()
+    # Connect straight to the cached address if the adapter still knows the device
+    cache = AddressCache()
+    device = find_cached_devices(ble, cache, [device_name]).get(device_name)
+    if device is None:
+        # Clear any cached data because both bluez and CoreBluetooth have issues with
+        # caching data and it going stale.
+        ble.clear_cached_data()
 
     # Get the first available BLE network adapter and make sure it's powered on.
     adapter = ble.get_default_adapter()
@@ -21,25 +26,24 @@ def main():
     # Disconnect any currently connected UART devices.  Good for cleaning up and
     # starting from a fresh state.
     print('Disconnecting any connected Timer devices...')
-    TimerService.disconnect_devices()
+    ble.disconnect_devices(TimerService.ADVERTISED)
 
-    # Scan for device
-    print('Searching for Timer device...')
+    print('Connecting to device...')
     try:
-        adapter.start_scan()
-        # Search for the first UART device found (will time out after 60 seconds
-        # but you can specify an optional timeout_sec parameter to change it).
-        device = ble.find_device(name=device_name)
+        if device is None:
+            raise RuntimeError('No cached address')
+        device.connect()  # Will time out after 60 seconds, specify timeout_sec parameter
+                          # to change the timeout.
+    except Exception:
+        # Scan for device (will time out after 60 seconds)
+        print('Searching for Timer device...')
+        ignore = [device.id] if device else []
+        device = scan_devices(ble, adapter, [device_name], ignore=ignore).get(device_name)
         if device is None:
             raise RuntimeError('Failed to find Timer device!')
-    finally:
-        # Make sure scanning is stopped before exiting.
-        adapter.stop_scan()
-        pass
-
-    print('Connecting to device...')
-    device.connect()  # Will time out after 60 seconds, specify timeout_sec parameter
-                      # to change the timeout.
+        device.connect()
+    cache.set(device_name, device.id)
+    cache.save()
     try:
         print('Discovering services...')
         TimerService.discover(device)